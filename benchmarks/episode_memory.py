@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+
+"""
+Compares the memory used by a synthetic library stored as trimmed info dicts (like older versions did)
+and as Episode records, and the size of the serialized videos of both.
+
+Usage: benchmarks/episode_memory.py [shows] [episodes per show]
+"""
+
+from sys import argv as sys_argv, path as sys_path
+import os
+import gc
+import json
+import tracemalloc
+
+sys_path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main
+
+###########
+
+SUBTITLE_LANGUAGES = ["enUS", "esLA", "esES", "frFR", "ptBR", "arME", "itIT", "deDE", "ruRU", "trTR"]
+
+def make_info(show, index):
+    """
+    Returns an info dict resembling the ones of CrunchyrollIE after get_info of older versions (only the first format).
+    """
+    media_id = show * 100000 + index
+    url = f"https://www.crunchyroll.com/show-{show}/episode-{index + 1}-title-{media_id}"
+    return {
+        "_type": "video",
+        "url": url,
+        "playlist_index": index,
+        "ie_key": "Crunchyroll",
+        "id": str(media_id),
+        "title": f"Show {show} Episode {index + 1} - Some Episode Title",
+        "description": "Some episode description. " * 15,
+        "duration": 1420.0,
+        "thumbnail": f"https://img1.ak.crunchyroll.com/i/spire{show}/{media_id}_full.jpg",
+        "uploader": "Some Studio",
+        "series": f"Show {show}",
+        "season": f"Show {show}",
+        "season_number": 1,
+        "episode": "Some Episode Title",
+        "episode_number": index + 1,
+        "timestamp": 1500000000 + media_id,
+        "subtitles": {
+            language: [{
+                "url": f"https://www.crunchyroll.com/xml/?req=RpcApiSubtitle_GetXml&subtitle_script_id={media_id}{number}",
+                "ext": ext,
+                } for ext in ("ass", "srt")]
+            for number, language in enumerate(SUBTITLE_LANGUAGES)
+        },
+        "formats": [{
+            "url": f"https://pl.crunchyroll.com/evs/{media_id}/index.m3u8?Policy={'x' * 200}&Signature={'y' * 300}",
+            "format_id": "hls-meta-0-audio-jaJP-hardsub-enUS-1080p",
+            "language": "jaJP",
+            "ext": "mp4",
+            "protocol": "m3u8",
+            "width": 1920,
+            "height": 1080,
+            "tbr": 5000,
+            "format_note": "hls",
+            }],
+    }
+
+def build_library(shows, episodes, compact):
+    library = {}
+    for show in range(shows):
+        videos = {}
+        for index in range(episodes):
+            info = make_info(show, index)
+            videos[index] = main.Episode.from_info(info, info["url"], index) if compact else info
+        library[f"Show {show}"] = videos
+    return library
+
+def measure(shows, episodes, compact):
+    gc.collect()
+    tracemalloc.start()
+    library = build_library(shows, episodes, compact)
+    gc.collect()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    serialized = sum(
+        len(json.dumps(video.to_dict() if compact else video, default=str))
+        for videos in library.values() for video in videos.values()
+        )
+    return current, serialized
+
+def run():
+    shows = int(sys_argv[1]) if len(sys_argv) > 1 else 20
+    episodes = int(sys_argv[2]) if len(sys_argv) > 2 else 250
+
+    print(f"Library: {shows} shows, {episodes} episodes each ({shows * episodes} episodes)")
+    for name, compact in (("Info dicts", False), ("Episode records", True)):
+        memory, serialized = measure(shows, episodes, compact)
+        print(f"{name + ':':17} memory {memory / 2**20:7.1f} MiB, serialized {serialized / 2**20:7.1f} MiB")
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+
+"""
+Compares load_urls_from_html with the BeautifulSoup based implementation it replaced
+on a large synthetic crunchyroll page.
+
+Usage: benchmarks/html_parser.py [sequences] [episodes per sequence]
+"""
+
+from sys import argv as sys_argv, path as sys_path
+import os
+import re
+import time
+import tempfile
+import tracemalloc
+
+sys_path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main
+
+###########
+
+def legacy_load_urls_from_html(html_path):
+    from bs4 import BeautifulSoup
+
+    res = []
+    with open(html_path, "r", encoding="utf-8") as html_file:
+        soup = BeautifulSoup(html_file, features="html.parser")
+
+    episode_sequences = soup.find_all("li", class_="season small-margin-bottom")
+    for index, episode_sequence in enumerate(episode_sequences):
+        episode_elements = episode_sequence.find_all("a", class_="portrait-element block-link titlefix episode")
+        urls = [ "https://www.crunchyroll.com" + episode_element["href"] for episode_element in episode_elements]
+        res.append(urls)
+
+    ep_number_regex = re.compile(r"(?<=\/episode-)(\d*)(\.){0,1}(\d*)(?=-)")
+    for urls in res:
+        urls.sort(key=lambda x: int("".join(re.findall(ep_number_regex, x)[0])), reverse=True)
+        urls.reverse()
+
+    return res
+
+def write_fixture(html_file, sequences, episodes):
+    """
+    Writes a page resembling a saved crunchyroll show page; episodes are listed newest first like on crunchyroll.
+    """
+    html_file.write("<!DOCTYPE html><html><head><title>Show - Watch on Crunchyroll</title></head><body>\n")
+    html_file.write("<div id='sidebar'>" + "<p class='filler'>Lorem ipsum dolor sit amet</p>" * 2000 + "</div>\n")
+    html_file.write("<ul class='list-of-seasons cf'>\n")
+    for sequence in range(sequences):
+        html_file.write(f"<li class='season small-margin-bottom'><a class='season-dropdown content-menu block' title='Season {sequence}'>Season {sequence}</a>\n")
+        html_file.write("<ul class='portrait-grid cf'>\n")
+        for episode in range(episodes, 0, -1):
+            media_id = sequence * 100000 + episode
+            html_file.write(
+                f"<li id='showview_videos_media_{media_id}' class='hover-bubble group-item'><div class='wrapper container-shadow hover-classes'>"
+                f"<a href='/show/episode-{episode}-title-{media_id}' title='Episode {episode}' class='portrait-element block-link titlefix episode'>"
+                f"<img class='landscape' src='https://img1.ak.crunchyroll.com/i/spire{episode}/thumb.jpg' alt=''>"
+                f"<span class='series-title block ellipsis'>Episode {episode}</span>"
+                f"<p class='short-desc'>{'Some episode description. ' * 10}</p></a></div></li>\n"
+                )
+        html_file.write("</ul></li>\n")
+    html_file.write("</ul></body></html>\n")
+
+def measure(function, html_path):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(html_path)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def run():
+    sequences = int(sys_argv[1]) if len(sys_argv) > 1 else 20
+    episodes = int(sys_argv[2]) if len(sys_argv) > 2 else 300
+
+    with tempfile.NamedTemporaryFile("w", suffix=".html", encoding="utf-8", delete=False) as html_file:
+        write_fixture(html_file, sequences, episodes)
+    try:
+        print(f"Fixture: {sequences} sequences, {episodes} episodes each, {os.path.getsize(html_file.name) / 2**20:.1f} MiB")
+        print("Parser backend:", "lxml" if main.optional_module("lxml.etree") is not None else "html.parser")
+
+        result, elapsed, peak = measure(main.load_urls_from_html, html_file.name)
+        print(f"load_urls_from_html:        {elapsed:7.3f} s, peak memory {peak / 2**20:7.1f} MiB")
+
+        try:
+            legacy_result, elapsed, peak = measure(legacy_load_urls_from_html, html_file.name)
+        except ImportError:
+            print("BeautifulSoup is not installed; skipping the legacy implementation")
+        else:
+            print(f"legacy_load_urls_from_html: {elapsed:7.3f} s, peak memory {peak / 2**20:7.1f} MiB")
+            print("Results are equal:", result == legacy_result)
+    finally:
+        os.remove(html_file.name)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+
+"""
+Runs get_info and start_download against a local stand-in for Crunchyroll and reports metadata throughput,
+download throughput, peak RSS and the peak number of threads for shows of 12, 300 and 1000 episodes.
+
+The stand-in server is used as HTTP proxy (youtube-dl option "proxy"), so the extractors request the usual
+http://www.crunchyroll.com URLs. It serves the show page, the episode pages and HLS streams of random data;
+the Crunchyroll API (https only) is refused, which the extractor tolerates.
+Every scenario runs in its own process, so peak RSS and threads are measured per scenario.
+
+Usage: benchmarks/stand_in_server.py [episodes ...] [options]
+    -latency <seconds>      Latency of every response (Default: 0.02)
+    -bandwidth <MiB/s>      Bandwidth shared by all responses (Default: 50)
+    -blocked <ratio>        Ratio of requests answered with HTTP 403 (Default: 0)
+    -region_locked <ratio>  Ratio of episodes which aren't available in the region (Default: 0.05)
+    -premium <ratio>        Ratio of the last episodes of every season which are only available to premium members (Default: 0)
+    -downloads <number>     Episodes to download per scenario (Default: 24)
+    -segments <number>      HLS segments per episode (Default: 4)
+    -segment_size <KiB>     Size of every segment (Default: 256)
+"""
+
+from sys import argv as sys_argv, executable as sys_executable, path as sys_path, exc_info as sys_exc_info
+import os
+import re
+import json
+import time
+import random
+import resource
+import tempfile
+import threading
+import subprocess
+import http.server
+from urllib.parse import urlparse
+
+sys_path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main
+
+# Episodes per season on the show page
+SEASON_LENGTH = 50
+
+###########
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.02, bandwidth=50, blocked=0, region_locked=0.05, premium=0, segments=4, segment_size=256):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth * 2**20
+        self.blocked = blocked
+        self.region_locked = region_locked
+        self.premium = premium
+        self.segments = segments
+        self.segment = random.Random(0).randbytes(segment_size * 1024)
+
+        # Bandwidth is shared like a single link: every chunk is sent once the previous ones would have been
+        self.lock = threading.Lock()
+        self.link_free = time.monotonic()
+
+        self.requests = 0
+        self.blocked_requests = 0
+
+    def throttle(self, size):
+        with self.lock:
+            start = max(time.monotonic(), self.link_free)
+            self.link_free = start + size / self.bandwidth
+            wait = self.link_free - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def handle_error(self, request, client_address):
+        # Clients closing connections (e.g. after an HTTP 403) aren't errors of the stand-in
+        if not isinstance(sys_exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def is_region_locked(self, media_id):
+        # The same episodes are locked in every run
+        return random.Random(media_id).random() < self.region_locked
+
+    def is_premium(self, show, media_id):
+        season, number = divmod(media_id, 100000)
+        length = min(SEASON_LENGTH, int(show.split("-")[1]) - (season - 1) * SEASON_LENGTH)
+        return number > length * (1 - self.premium)
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_CONNECT(self):
+        # HTTPS (the Crunchyroll API and login) isn't available
+        self.send_response(502)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.send_body(404, b"")
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.latency)
+        if server.blocked and random.random() < server.blocked:
+            with server.lock:
+                server.blocked_requests += 1
+            return self.send_body(403, b"Forbidden")
+
+        path = urlparse(self.path).path
+        match = re.fullmatch(r"/hls/(\d+)/index\.m3u8", path)
+        if match:
+            return self.send_body(200, self.manifest(match.group(1)).encode(), "application/vnd.apple.mpegurl")
+        match = re.fullmatch(r"/hls/\d+/segment(\d+)\.ts", path)
+        if match:
+            return self.send_body(200, server.segment, "video/mp2t")
+        match = re.fullmatch(r"/(show-(\d+))/episode-(\d+)-[\w-]*?(\d+)", path)
+        if match:
+            return self.send_body(200, self.episode_page(match.group(1), int(match.group(3)), int(match.group(4))).encode())
+        match = re.fullmatch(r"/(show-(\d+))/?", path)
+        if match:
+            return self.send_body(200, self.show_page(match.group(1), int(match.group(2))).encode())
+        self.send_body(404, b"Not found")
+
+    def send_body(self, status, body, content_type="text/html; charset=utf-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        for start in range(0, len(body), 64 * 1024):
+            chunk = body[start:start + 64 * 1024]
+            self.server.throttle(len(chunk))
+            self.wfile.write(chunk)
+
+    def proxy_url(self, path):
+        return f"http://127.0.0.1:{self.server.server_address[1]}{path}"
+
+    def show_page(self, show, episodes):
+        # Newest season and episode first, like on crunchyroll
+        seasons = [range(start, min(start + SEASON_LENGTH, episodes)) for start in range(0, episodes, SEASON_LENGTH)]
+        items = []
+        for season, indices in reversed(list(enumerate(seasons))):
+            items.append(f'<li class="season small-margin-bottom"><a class="season-dropdown" title="Season {season + 1}">Season {season + 1}</a><ul>')
+            for index in reversed(indices):
+                number = index - indices.start + 1
+                media_id = 100000 * (season + 1) + number
+                items.append(
+                    f'<li id="showview_videos_media_{media_id}" class="hover-bubble group-item">'
+                    f'<a href="/{show}/episode-{number}-title-{media_id}" title="Episode {number}" '
+                    f'class="portrait-element block-link titlefix episode">Episode {number}</a></li>'
+                    )
+            items.append("</ul></li>")
+        return (f'<html><head><meta itemprop="name" content="{show}"><title>{show} - Watch on Crunchyroll</title></head>'
+            f'<body><ul class="list-of-seasons cf">{"".join(items)}</ul></body></html>')
+
+    def episode_page(self, show, number, media_id):
+        if self.server.is_region_locked(media_id):
+            message = json.dumps({"type": "error", "message_body": "Sorry, this video is not available in your region due to licensing restrictions."})
+            return f"<html><body><script>Page.messaging_box_controller.addItems([{message}]);</script></body></html>"
+        if self.server.is_premium(show, media_id):
+            message = json.dumps({"type": "error", "message_body": "This video is only available to premium members."})
+            return f"<html><body><script>Page.messaging_box_controller.addItems([{message}]);</script></body></html>"
+
+        media = {
+            "metadata": {"title": f"Title {number}", "episode_number": str(number), "duration": 1420000},
+            "streams": [{"format": "adaptive_hls", "audio_lang": "jaJP", "hardsub_lang": "enUS", "url": self.proxy_url(f"/hls/{media_id}/index.m3u8")}],
+            "subtitles": []
+        }
+        return (f"<html><head><title>{show} Episode {number} - Title {number}, - Watch on Crunchyroll</title></head><body>"
+            f'<h1 class="ellipsis"><a href="/{show}">{show}</a> Episode {number} - <span itemprop="title">Title {number}</span></h1>'
+            f'<h1 id="showmedia_about_episode_num" class="ellipsis"><a href="/{show}">{show}</a></h1><h4>Season {media_id // 100000} Episode {number}</h4>'
+            f'<script>vilos.config.media = {json.dumps(media)};\nvilos.config.player.language = "enUS";</script>'
+            "</body></html>")
+
+    def manifest(self, media_id):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:4", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for index in range(self.server.segments):
+            lines.extend(["#EXTINF:4.000,", f"segment{index}.ts"])
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+###########
+
+def scenario(port, episodes, downloads):
+    """
+    Runs in its own process; prints the results as JSON.
+    """
+    peak_threads = threading.active_count()
+    done = threading.Event()
+
+    def monitor():
+        nonlocal peak_threads
+        while not done.wait(0.05):
+            peak_threads = max(peak_threads, threading.active_count())
+    threading.Thread(target=monitor, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as output:
+        anime = main.Anime()
+        anime.limiter.backoff = 0.1
+        anime.config.update({
+            "url": f"http://www.crunchyroll.com/show-{episodes}",
+            "output": os.path.join(output, main.DEFAULT_OUTPUT_SYNTAX),
+            "custom": {"proxy": f"http://127.0.0.1:{port}", "postprocessors": [], "fixup": "never"},
+        })
+
+        start = time.perf_counter()
+        anime.get_info()
+        metadata_time = time.perf_counter() - start
+
+        available = [index for index, episode in anime.config["videos"].items() if episode.available]
+        start = time.perf_counter()
+        anime.start_download(available[:downloads])
+        download_time = time.perf_counter() - start
+
+        downloaded = sum(os.path.getsize(os.path.join(output, name)) for name in os.listdir(output) if name.endswith(".mp4"))
+        files = sum(name.endswith(".mp4") for name in os.listdir(output))
+
+    done.set()
+    print(json.dumps({
+        "checked": len(anime.config["videos"]),
+        "available": len(available),
+        "metadata_time": metadata_time,
+        "downloaded": files,
+        "download_bytes": downloaded,
+        "download_time": download_time,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "peak_threads": max(peak_threads, threading.active_count()),
+        "blocked": anime.limiter.blocked
+    }))
+
+def option(arguments, name, default):
+    if name in arguments:
+        value = float(arguments.pop(arguments.index(name)+1))
+        arguments.remove(name)
+        return value
+    return default
+
+def run():
+    arguments = sys_argv[1:]
+    if "--scenario" in arguments:
+        return scenario(*[int(argument) for argument in arguments[1:4]])
+
+    server = StandInServer(
+        latency=option(arguments, "-latency", 0.02),
+        bandwidth=option(arguments, "-bandwidth", 50),
+        blocked=option(arguments, "-blocked", 0),
+        region_locked=option(arguments, "-region_locked", 0.05),
+        premium=option(arguments, "-premium", 0),
+        segments=int(option(arguments, "-segments", 4)),
+        segment_size=int(option(arguments, "-segment_size", 256))
+        )
+    downloads = int(option(arguments, "-downloads", 24))
+    shows = [int(argument) for argument in arguments] or [12, 300, 1000]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    print(f"Latency {server.latency * 1000:.0f} ms, bandwidth {server.bandwidth / 2**20:.0f} MiB/s, "
+        f"{server.blocked:.0%} blocked requests, {server.region_locked:.0%} region locked episodes, {server.premium:.0%} premium episodes")
+    table = main.PrettyTable(["Episodes", "Metadata (episodes/s)", "Downloads", "Download (MiB/s)", "Peak RSS (MiB)", "Peak threads", "Blocked"])
+    for episodes in shows:
+        result = subprocess.run(
+            [sys_executable, os.path.abspath(__file__), "--scenario", str(server.server_address[1]), str(episodes), str(downloads)],
+            capture_output=True, text=True
+            )
+        if result.returncode:
+            print(result.stderr)
+            continue
+        result = json.loads(result.stdout.splitlines()[-1])
+        table.add_row([
+            f"{result['available']}/{result['checked']}",
+            f"{result['checked'] / result['metadata_time']:.1f}",
+            result["downloaded"],
+            f"{result['download_bytes'] / 2**20 / result['download_time']:.1f}",
+            f"{result['peak_rss'] / 2**20:.0f}",
+            result["peak_threads"],
+            result["blocked"]
+            ])
+    print(table)
+    print(f"Requests: {server.requests} ({server.blocked_requests} blocked)")
+
+if __name__ == "__main__":
+    run()
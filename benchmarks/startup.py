@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+"""
+Compares the import time of main.py (measured with python -X importtime) with the modules
+older versions imported at startup: youtube_dl with all extractors, PyYAML, prettytable and the optional modules.
+Also measures the wall time of "main.py --list".
+
+Usage: benchmarks/startup.py [runs]
+"""
+
+from sys import argv as sys_argv, executable as sys_executable
+import os
+import re
+import time
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# What older versions imported when main.py was started
+EAGER_IMPORTS = ["import youtube_dl", "import yaml", "import prettytable", "import asyncio", "import http.server", "import lxml.etree", "import Crypto.Cipher.AES"]
+
+###########
+
+def import_time(code):
+    """
+    Returns the seconds spent importing the modules imported by code (top level imports of -X importtime).
+    """
+    result = subprocess.run([sys_executable, "-X", "importtime", "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    total = 0
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\S.*)$", line)
+        # Only top level imports; their cumulative time includes the nested ones
+        if match and not match.group(2).startswith(" "):
+            total += int(match.group(1))
+    return total / 1e6
+
+def wall_time(arguments):
+    start = time.perf_counter()
+    subprocess.run([sys_executable, "main.py", *arguments], cwd=ROOT, capture_output=True, check=True)
+    return time.perf_counter() - start
+
+def run():
+    runs = int(sys_argv[1]) if len(sys_argv) > 1 else 5
+
+    # Optional modules which aren't installed are left out
+    eager = "".join(f"try:\n    {statement}\nexcept ImportError:\n    pass\n" for statement in EAGER_IMPORTS)
+
+    lazy_times = [import_time("import main") for _ in range(runs)]
+    eager_times = [import_time(eager + "import main") for _ in range(runs)]
+    print(f"import main:                      {statistics.median(lazy_times) * 1000:7.1f} ms (median of {runs})")
+    print(f"import main with eager imports:   {statistics.median(eager_times) * 1000:7.1f} ms (median of {runs})")
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, "config.db")
+        list_times = [wall_time(["-c", config_path, "--list"]) for _ in range(runs)]
+    print(f"main.py --list:                   {statistics.median(list_times) * 1000:7.1f} ms wall time (median of {runs})")
+
+if __name__ == "__main__":
+    run()
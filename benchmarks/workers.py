@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+"""
+Downloads a show of the stand-in server (see stand_in_server.py) with a coordinator (main.py --daemon -coordinator)
+and 1, 2 and 4 worker processes (main.py -worker) and reports the aggregate download throughput.
+Every worker uses its own stand-in server with its own bandwidth cap as proxy, like workers with their own VPN exit IP.
+
+Usage: benchmarks/workers.py [workers ...] [options]
+    -episodes <number>      Episodes of the show (Default: 24)
+    -bandwidth <MiB/s>      Bandwidth of every stand-in server (Default: 2)
+    -latency <seconds>      Latency of every response (Default: 0.02)
+    -j <number>             Episodes every worker downloads at once (Default: 2)
+"""
+
+from sys import argv as sys_argv, executable as sys_executable
+import os
+import time
+import json
+import socket
+import sqlite3
+import tempfile
+import threading
+import subprocess
+
+# Also makes main importable
+from stand_in_server import StandInServer, option
+import main
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main.py")
+
+###########
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def start(arguments, server, log):
+    proxy = f"http://127.0.0.1:{server.server_address[1]}"
+    env = dict(os.environ, http_proxy=proxy, https_proxy=proxy, no_proxy="")
+    return subprocess.Popen([sys_executable, MAIN, "-nf", *arguments], env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def job_status(config_path):
+    try:
+        with sqlite3.connect(config_path) as db:
+            row = db.execute("SELECT status, error FROM jobs ORDER BY id LIMIT 1").fetchone()
+    except sqlite3.Error:
+        return None
+    return row
+
+def scenario(workers, episodes, bandwidth, latency, slots):
+    # One stand-in server per worker (and one for the coordinator)
+    servers = [StandInServer(latency=latency, bandwidth=bandwidth, region_locked=0, segments=8) for _ in range(workers + 1)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, "config.db")
+        output = os.path.join(directory, "downloads")
+        os.makedirs(output)
+        with open(os.path.join(directory, "jobs.jsonl"), "w", encoding="utf-8") as jobs_file:
+            jobs_file.write(json.dumps({"url": f"http://www.crunchyroll.com/show-{episodes}", "output": output}) + "\n")
+
+        port = free_port()
+        log = open(os.path.join(directory, "log.txt"), "w")
+        processes = [start(["--daemon", "-c", config_path, "-coordinator", str(port)], servers[0], log)]
+        try:
+            start_time = time.perf_counter()
+            # Workers which can't connect wait a few seconds before they try again
+            while processes[0].poll() is None:
+                try:
+                    socket.create_connection(("127.0.0.1", port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            for worker in range(workers):
+                worker_path = os.path.join(directory, f"worker{worker}.db")
+                processes.append(start(["-worker", f"127.0.0.1:{port}", "-c", worker_path, "-j", str(slots)], servers[worker + 1], log))
+
+            while True:
+                status = job_status(config_path)
+                if status and status[0] in ["done", "failed"]:
+                    break
+                if processes[0].poll() is not None:
+                    status = ("failed", "The coordinator exited")
+                    break
+                time.sleep(0.2)
+            elapsed = time.perf_counter() - start_time
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+            log.close()
+
+        downloaded = sum(os.path.getsize(os.path.join(output, name)) for name in os.listdir(output) if name.endswith(".mp4"))
+        files = sum(name.endswith(".mp4") for name in os.listdir(output))
+        if status[0] == "failed":
+            with open(os.path.join(directory, "log.txt"), encoding="utf-8") as log:
+                print(log.read()[-3000:])
+
+    for server in servers:
+        server.shutdown()
+    return {
+        "status": status[0],
+        "downloaded": files,
+        "elapsed": elapsed,
+        "throughput": downloaded / 2**20 / elapsed,
+        # Requests of the workers' exit IPs
+        "requests": [server.requests for server in servers[1:]]
+        }
+
+def run():
+    arguments = sys_argv[1:]
+    episodes = int(option(arguments, "-episodes", 24))
+    bandwidth = option(arguments, "-bandwidth", 2)
+    latency = option(arguments, "-latency", 0.02)
+    slots = int(option(arguments, "-j", 2))
+    counts = [int(argument) for argument in arguments] or [1, 2, 4]
+
+    print(f"{episodes} episodes, {bandwidth:g} MiB/s per exit IP, {slots} episodes per worker at once")
+    table = main.PrettyTable(["Workers", "Job", "Episodes", "Time (s)", "Throughput (MiB/s)", "Requests per worker"])
+    for workers in counts:
+        result = scenario(workers, episodes, bandwidth, latency, slots)
+        table.add_row([
+            workers, result["status"], result["downloaded"], f"{result['elapsed']:.1f}",
+            f"{result['throughput']:.1f}", ", ".join(str(requests) for requests in result["requests"])
+            ])
+    print(table)
+
+if __name__ == "__main__":
+    run()
@@ -1,37 +1,64 @@
 #!/usr/bin/python3
 
+import sys
 from sys import exit, argv as sys_argv, executable as sys_executable
 from subprocess import check_call, CalledProcessError
 from shutil import which
 from urllib.parse import urlparse, urlunparse
 import re
 import os
+import json
+import time
+import random
+import heapq
+import itertools
+import struct
+import sqlite3
+import tempfile
+import socket
+import binascii
+import hashlib
+import contextlib
+import functools
+import importlib
+import importlib.util
+import types
+import asyncio
+import socketserver
+import threading
+import http.client
+import html.parser
+import urllib.error
+import urllib.request
 import concurrent.futures
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 
 ###########
 
-if __name__ == "__main__":
-    try:
-        import youtube_dl
-        import yaml
-        from prettytable import PrettyTable
-        from bs4 import BeautifulSoup
-    except ModuleNotFoundError as e:
-        print("Some required modules were not found:\n", e, "\n\nPlease ensure all modules listed in requirements.txt are installed.")
-        exit()
-else:
-    import youtube_dl
-    from bs4 import BeautifulSoup
+# Heavy modules are imported when they are needed:
+## youtube_dl and ytdl.py (the classes based on it) by load_youtube_dl()
+youtube_dl = None
+ytdl = None
+youtube_dl_lock = threading.Lock()
+## tkinter.filedialog by get_filedialog()
+filedialog = None
+## PyYAML by migrate_config(); prettytable by PrettyTable()
+## Optional modules with optional_module(): Crypto.Cipher.AES (AES-128 encrypted HLS segments), lxml.etree (faster parser for saved pages)
+
+# ytdl.py imports from this module, also when it is run as a script
+sys.modules.setdefault("main", sys.modules[__name__])
 
 ###########
 
 class Logger(object):
-    def __init__(self, verbosity):
+    def __init__(self, verbosity, size=1000):
         self.verbosity = verbosity
-        self.output = ""
+        # Last debug messages
+        self.output = deque(maxlen=size)
 
     def debug(self, msg):
-        self.output += msg
+        self.output.append(msg)
         if self.verbosity > 2:
             print(msg)
 
@@ -42,27 +69,1466 @@ class Logger(object):
     def error(self, msg):
         if self.verbosity > 0:
             print(msg)
-            
-class Anime():
+
+class MetadataCache(object):
+    """
+    Persistent cache for the info dicts returned by CrunchyrollIE, keyed by the episode URL without language tag
+    and stored in the metadata table of a StateStore, so every entry is written on its own.
+    Entries expire after self.ttl seconds ({"error": ...} results after self.error_ttl seconds);
+    the least recently used entries get evicted once there are more than self.max_entries.
+    """
+
+    def __init__(self, state, ttl=7*24*60*60, error_ttl=6*60*60, max_entries=10000):
+        self.state = state
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_entries = max_entries
+        # Ignore cached entries (but still update them)
+        self.refresh = False
+
+        # key: time of the last cache hit, written by save()
+        self.used = {}
+        self.lock = threading.Lock()
+
+    def save(self):
+        """
+        Write the times of the cache hits since the last save; the entries themselves are written by put().
+        """
+        with self.lock:
+            used, self.used = self.used, {}
+        if used:
+            self.state.touch_metadata(used)
+
+    def get(self, url):
+        """
+        Returns a copy of the cached info dict for url or None if there is no valid entry.
+        """
+        if self.refresh:
+            return None
+
+        key = remove_lang_tag(url)
+        entry = self.state.load_metadata(key)
+        if entry is None:
+            return None
+        expires, data = entry
+        if expires <= time.time():
+            self.state.delete_metadata(key)
+            return None
+        with self.lock:
+            self.used[key] = time.time()
+
+        # Every caller gets its own copy since get_info modifies the dict
+        return json.loads(data)
+
+    def put(self, url, info):
+        ttl = self.error_ttl if "error" in info else self.ttl
+        data = json.dumps(info, default=str)
+
+        key = remove_lang_tag(url)
+        with self.lock:
+            self.used.pop(key, None)
+        self.state.save_metadata(key, time.time() + ttl, data, self.max_entries)
+
+class SubtitleStore(object):
+    """
+    Content-addressed store for subtitle tracks, keyed by episode id, language and format.
+    Every distinct track is stored once in self.path (named by its SHA-256), so identical tracks of several episodes
+    share a file; the least recently used tracks get evicted once the files take more than self.max_size bytes.
+    """
+
+    def __init__(self, path, max_size=256*2**20):
+        self.path = path
+        self.max_size = max_size
+
+        # "episode id/language/format": hash, least recently used first
+        self.tracks = OrderedDict()
+        # hash: [size, number of tracks]
+        self.files = {}
+        self.size = 0
+        self.changed = False
+        self.lock = threading.Lock()
+        # Serializes save()
+        self.save_lock = threading.Lock()
+
+        self.load()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, "index.json")
+
+    def load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as index_file:
+                tracks = json.load(index_file)
+        except (OSError, ValueError):
+            tracks = []
+
+        with self.lock:
+            for key, digest in tracks:
+                if digest not in self.files:
+                    try:
+                        self.files[digest] = [os.path.getsize(os.path.join(self.path, digest)), 0]
+                    except OSError:
+                        continue
+                    self.size += self.files[digest][0]
+                self.files[digest][1] += 1
+                self.tracks[key] = digest
+
+    def save(self):
+        """
+        Atomically write the index to self.path if anything changed.
+        """
+        # Batches of several anime save at the same time; the latest index is written last
+        with self.save_lock:
+            with self.lock:
+                if not self.changed:
+                    return
+                tracks = list(self.tracks.items())
+                self.changed = False
+
+            os.makedirs(self.path, exist_ok=True)
+            handle, temp_path = tempfile.mkstemp(dir=self.path, prefix="index.", suffix=".tmp")
+            try:
+                with open(handle, "w", encoding="utf-8") as index_file:
+                    json.dump(tracks, index_file)
+                os.replace(temp_path, self.index_path)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(temp_path)
+                with self.lock:
+                    self.changed = True
+                raise
+
+    def get(self, episode_id, language, ext):
+        """
+        Returns the stored track as bytes or None.
+        """
+        key = f"{episode_id}/{language}/{ext}"
+        with self.lock:
+            digest = self.tracks.get(key)
+            if digest is None:
+                return None
+            self.tracks.move_to_end(key)
+            self.changed = True
+
+        try:
+            with open(os.path.join(self.path, digest), "rb") as track_file:
+                return track_file.read()
+        except OSError:
+            with self.lock:
+                if self.tracks.get(key) == digest:
+                    self._remove(key)
+            return None
+
+    def put(self, episode_id, language, ext, data):
+        digest = hashlib.sha256(data).hexdigest()
+        key = f"{episode_id}/{language}/{ext}"
+
+        with self.lock:
+            if self.tracks.get(key) == digest:
+                self.tracks.move_to_end(key)
+                return
+            if key in self.tracks:
+                self._remove(key)
+            # Tracks are small, so they are written while holding the lock
+            if digest not in self.files:
+                os.makedirs(self.path, exist_ok=True)
+                temp_path = os.path.join(self.path, digest + ".tmp")
+                with open(temp_path, "wb") as track_file:
+                    track_file.write(data)
+                os.replace(temp_path, os.path.join(self.path, digest))
+                self.files[digest] = [len(data), 0]
+                self.size += len(data)
+            self.files[digest][1] += 1
+            self.tracks[key] = digest
+            self.changed = True
+
+            while self.size > self.max_size and len(self.tracks) > 1:
+                self._remove(next(iter(self.tracks)))
+
+    def _remove(self, key):
+        """
+        Removes the track key and deletes its file if no other track uses it. self.lock has to be held.
+        """
+        digest = self.tracks.pop(key)
+        self.changed = True
+        self.files[digest][1] -= 1
+        if self.files[digest][1] == 0:
+            self.size -= self.files.pop(digest)[0]
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.path, digest))
+
+class StateStore(object):
+    """
+    SQLite database holding the general config, the config of every anime and the unfinished sessions.
+    Every anime is stored as one record plus one record per video, so saving an anime only writes what changed
+    and anime configs are only read when they are used.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+
+        # Hashes of the records as they are in the database; title: {"data": hash, "videos": {index: hash}}
+        self.saved = {}
+
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS general (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS anime (title TEXT PRIMARY KEY, id TEXT, url TEXT, data TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS anime_id ON anime (id)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS videos (title TEXT, playlist_index INTEGER, data TEXT, PRIMARY KEY (title, playlist_index))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, episodes TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, spec TEXT, status TEXT, error TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS progress (title TEXT, playlist_index INTEGER, filename TEXT, downloaded INTEGER, PRIMARY KEY (title, playlist_index))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, expires REAL, used REAL, data TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS metadata_used ON metadata (used)")
+
+    def is_empty(self):
+        with self.lock:
+            return not self.db.execute("SELECT 1 FROM general UNION ALL SELECT 1 FROM anime LIMIT 1").fetchone()
+
+    def load_general(self):
+        with self.lock:
+            rows = self.db.execute("SELECT key, value FROM general").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_general(self, general):
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO general (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                [(key, json.dumps(value)) for key, value in general.items()]
+                )
+
+    def titles(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT title FROM anime ORDER BY rowid")]
+
+    def load_anime(self, title):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM anime WHERE title = ?", (title,)).fetchone()
+            if row is None:
+                raise KeyError(title)
+            video_rows = self.db.execute("SELECT playlist_index, data FROM videos WHERE title = ? ORDER BY playlist_index", (title,)).fetchall()
+
+        anime_config = json.loads(row[0])
+        if anime_config["videos"] is not None:
+            anime_config["videos"] = {index: Episode.from_dict(json.loads(data)) for index, data in video_rows}
+
+        self.saved[title] = {
+            "data": hash(row[0]),
+            "videos": {index: hash(data) for index, data in video_rows}
+        }
+        return anime_config
+
+    def save_anime(self, anime_config):
+        """
+        Write the records of anime_config which differ from the ones in the database.
+        """
+        title = anime_config["title"]
+        videos = anime_config["videos"] or {}
+
+        data = dict(anime_config)
+        # Videos are stored in their own records
+        data["videos"] = None if anime_config["videos"] is None else {}
+        data = json.dumps(data, default=str)
+
+        with self.lock, self.db:
+            if title not in self.saved:
+                video_rows = self.db.execute("SELECT playlist_index, data FROM videos WHERE title = ?", (title,)).fetchall()
+                self.saved[title] = {
+                    "data": None,
+                    "videos": {index: hash(video_data) for index, video_data in video_rows}
+                }
+            saved = self.saved[title]
+
+            if saved["data"] != hash(data):
+                self.db.execute(
+                    "INSERT INTO anime (title, id, url, data) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (title) DO UPDATE SET id = excluded.id, url = excluded.url, data = excluded.data",
+                    (title, anime_config.get("id"), anime_config.get("url"), data)
+                    )
+                saved["data"] = hash(data)
+
+            for index, episode in videos.items():
+                video_data = json.dumps(episode.to_dict(), default=str)
+                if saved["videos"].get(int(index)) != hash(video_data):
+                    self.db.execute(
+                        "INSERT INTO videos (title, playlist_index, data) VALUES (?, ?, ?) "
+                        "ON CONFLICT (title, playlist_index) DO UPDATE SET data = excluded.data",
+                        (title, int(index), video_data)
+                        )
+                    saved["videos"][int(index)] = hash(video_data)
+
+            # Remove videos which are no longer part of the playlist
+            for index in set(saved["videos"]) - {int(index) for index in videos}:
+                self.db.execute("DELETE FROM videos WHERE title = ? AND playlist_index = ?", (title, index))
+                del saved["videos"][index]
+
+    def delete_anime(self, title):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM anime WHERE title = ?", (title,))
+            self.db.execute("DELETE FROM videos WHERE title = ?", (title,))
+            self.db.execute("DELETE FROM progress WHERE title = ?", (title,))
+            self.saved.pop(title, None)
+
+    def load_progress(self, title):
+        """
+        Returns {index: (temporary filename, downloaded bytes)} of the unfinished downloads of title.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT playlist_index, filename, downloaded FROM progress WHERE title = ?", (title,)).fetchall()
+        return {index: (filename, downloaded) for index, filename, downloaded in rows}
+
+    def save_progress(self, title, index, filename, downloaded):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO progress (title, playlist_index, filename, downloaded) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (title, playlist_index) DO UPDATE SET filename = excluded.filename, downloaded = excluded.downloaded",
+                (title, index, filename, downloaded)
+                )
+
+    def delete_progress(self, title, index):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM progress WHERE title = ? AND playlist_index = ?", (title, index))
+
+    def load_metadata(self, key):
+        """
+        Returns (expiry timestamp, info dict as JSON string) of the MetadataCache entry key or None.
+        """
+        with self.lock:
+            return self.db.execute("SELECT expires, data FROM metadata WHERE key = ?", (key,)).fetchone()
+
+    def save_metadata(self, key, expires, data, max_entries):
+        """
+        Write the MetadataCache entry key and evict the least recently used entries beyond max_entries.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO metadata (key, expires, used, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET expires = excluded.expires, used = excluded.used, data = excluded.data",
+                (key, expires, time.time(), data)
+                )
+            excess = self.db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0] - max_entries
+            if excess > 0:
+                self.db.execute("DELETE FROM metadata WHERE key IN (SELECT key FROM metadata ORDER BY used LIMIT ?)", (excess,))
+
+    def touch_metadata(self, used):
+        """
+        Update the times of the last use of MetadataCache entries; used: {key: timestamp}
+        """
+        with self.lock, self.db:
+            self.db.executemany("UPDATE metadata SET used = ? WHERE key = ?", [(timestamp, key) for key, timestamp in used.items()])
+
+    def delete_metadata(self, key):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM metadata WHERE key = ?", (key,))
+
+    def remap_progress(self, title, remap):
+        """
+        Move the unfinished downloads of title to new indices; remap: {old index: new index}
+        Downloads of indices which aren't in remap are forgotten.
+        """
+        with self.lock, self.db:
+            rows = self.db.execute("SELECT playlist_index, filename, downloaded FROM progress WHERE title = ?", (title,)).fetchall()
+            self.db.execute("DELETE FROM progress WHERE title = ?", (title,))
+            self.db.executemany(
+                "INSERT INTO progress (title, playlist_index, filename, downloaded) VALUES (?, ?, ?, ?)",
+                [(title, remap[index], filename, downloaded) for index, filename, downloaded in rows if index in remap]
+                )
+
+    def load_sessions(self):
+        with self.lock:
+            rows = self.db.execute("SELECT title, episodes FROM sessions ORDER BY id").fetchall()
+        return [[title, json.loads(episodes)] for title, episodes in rows]
+
+    def save_sessions(self, sessions):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM sessions")
+            self.db.executemany(
+                "INSERT INTO sessions (title, episodes) VALUES (?, ?)",
+                [(title, json.dumps(episodes)) for title, episodes in sessions]
+                )
+
+    def add_job(self, spec):
+        with self.lock, self.db:
+            return self.db.execute("INSERT INTO jobs (spec, status) VALUES (?, 'queued')", (json.dumps(spec),)).lastrowid
+
+    def next_job(self):
+        """
+        Mark the oldest queued job with the lowest priority as running and return (id, spec) of it or None if there is none.
+        """
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT id, spec FROM jobs WHERE status = 'queued' ORDER BY COALESCE(json_extract(spec, '$.priority'), 1), id LIMIT 1"
+                ).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE jobs SET status = 'running' WHERE id = ?", (row[0],))
+        return row[0], json.loads(row[1])
+
+    def finish_job(self, job_id, error=None):
+        with self.lock, self.db:
+            self.db.execute("UPDATE jobs SET status = ?, error = ? WHERE id = ?", ("failed" if error else "done", error, job_id))
+
+    def job_counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def requeue_jobs(self):
+        """
+        Queue jobs again which were interrupted while running.
+        """
+        with self.lock, self.db:
+            return self.db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+
+class AnimeIndex(MutableMapping):
+    """
+    Mapping of title: anime config, which loads the anime configs from a StateStore when they are accessed
+    and writes them back when they are assigned.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.titles = state.titles()
+        self.loaded = {}
+
+    def __getitem__(self, title):
+        if title not in self.loaded:
+            self.loaded[title] = self.state.load_anime(title)
+        return self.loaded[title]
+
+    def __setitem__(self, title, anime_config):
+        self.state.save_anime(anime_config)
+        self.loaded[title] = anime_config
+        if title not in self.titles:
+            self.titles.append(title)
+
+    def __delitem__(self, title):
+        self.state.delete_anime(title)
+        self.loaded.pop(title, None)
+        self.titles.remove(title)
+
+    def __iter__(self):
+        return iter(list(self.titles))
+
+    def __len__(self):
+        return len(self.titles)
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all threads sending requests to Crunchyroll.
+    Requests are only limited by self.concurrency until Crunchyroll blocks one with HTTP 403 or 429; then the request rate
+    and the number of concurrent requests are halved, grow slowly after successful requests (AIMD)
+    and the rate limit is lifted again once it reaches self.max_rate.
+    Blocked requests are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, rate=None, min_rate=0.5, max_rate=100, concurrency=50, retries=4, backoff=2):
+        # Requests per second; None while requests aren't blocked
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.concurrency = concurrency
+        self.max_concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+
+        self.tokens = rate or 0
+        self.refilled = time.monotonic()
+        self.active = 0
+        self.condition = threading.Condition()
+
+        # Statistics
+        self.started = time.monotonic()
+        self.requests = 0
+        self.blocked = 0
+        self.successes = 0
+
+    def __str__(self):
+        limit = f"{self.rate:.2f}/s" if self.rate else "none"
+        return (f"Requests: {self.requests} ({self.blocked} blocked), effective rate: {self.effective_rate():.2f}/s, "
+            f"current limit: {limit} with {self.concurrency} concurrent requests")
+
+    def effective_rate(self):
+        return self.requests / max(time.monotonic() - self.started, 1e-6)
+
+    def metrics(self):
+        return {
+            "requests_total": self.requests,
+            "requests_blocked_total": self.blocked,
+            # 0 while the rate isn't limited
+            "request_rate_limit": self.rate or 0,
+            "request_concurrency_limit": self.concurrency
+            }
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            # Allow bursts of up to one second worth of requests
+            self.tokens = min(max(self.rate, 1), self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def acquire(self, slot=True):
+        """
+        Block until a request may be sent. Unless slot is set, the request doesn't count against self.concurrency
+        (e.g. the requests of a download, which runs for minutes).
+        """
+        with self.condition:
+            while True:
+                self._refill()
+                if (not self.rate or self.tokens >= 1) and (not slot or self.active < self.concurrency):
+                    if self.rate:
+                        self.tokens -= 1
+                    if slot:
+                        self.active += 1
+                    self.requests += 1
+                    return
+                self.condition.wait((1 - self.tokens) / self.rate if self.rate and self.tokens < 1 else None)
+
+    def release(self, blocked=False, slot=True):
+        with self.condition:
+            if slot:
+                self.active -= 1
+            if blocked:
+                # Multiplicative decrease
+                self.blocked += 1
+                self.rate = max(self.min_rate, (self.rate or self.max_rate) / 2)
+                self.concurrency = max(1, self.concurrency // 2)
+                self.tokens = min(self.tokens, 0)
+            else:
+                # Additive increase; roughly one request per second and one concurrent request per window
+                self.successes += 1
+                if self.rate:
+                    self.rate += 1 / self.rate
+                    if self.rate >= self.max_rate:
+                        self.rate = None
+                if self.successes % self.concurrency == 0:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.condition.notify_all()
+
+    def call(self, function, *args, slot=True, **kwargs):
+        """
+        Call function once a request may be sent; retry if it was blocked. See acquire() for slot.
+        """
+        for attempt in range(self.retries + 1):
+            self.acquire(slot)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                blocked = is_blocked(error)
+                self.release(blocked, slot)
+                if not blocked or attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+            else:
+                self.release(slot=slot)
+                return result
+
+class DownloadTuner(object):
+    """
+    Adjusts the number of concurrent downloads of a batch to the available bandwidth.
+    The throughput is measured from the progress hooks in windows of self.interval seconds; one more download is allowed
+    as long as the last one increased the throughput by at least self.min_gain (hill climbing)
+    and the number of downloads is halved when downloads fail.
+    Once settled, more downloads are tried again after self.reprobe_interval seconds or when all downloads have finished (see reset()),
+    so a long-running scheduler recovers from temporary errors.
+    """
+
+    def __init__(self, max_workers=10, workers=2, interval=10, min_gain=0.05, reprobe_interval=30*60, log=print):
+        self.max_workers = max_workers
+        self.workers = max(1, min(workers, max_workers))
+        self.interval = interval
+        self.min_gain = min_gain
+        self.reprobe_interval = reprobe_interval
+        self.log = log
+
+        self.active = 0
+        self.condition = threading.Condition()
+
+        # Bytes per file as last reported by the progress hooks
+        self.reported = {}
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_errors = 0
+        # Throughput before the last additional download was allowed
+        self.previous = None
+        self.throughput = 0
+        self.settled = False
+        self.settled_at = None
+
+    def __str__(self):
+        return (f"Download threads: {self.workers} of {self.max_workers}{' (settled)' if self.settled else ''}, "
+            f"throughput: {self.throughput / 2**20:.2f} MiB/s")
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.workers:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def progress(self, status):
+        """
+        Progress hook of youtube-dl.
+        """
+        filename = status.get("tmpfilename") or status.get("filename")
+        downloaded = status.get("downloaded_bytes")
+        if downloaded is None:
+            return
+
+        with self.condition:
+            # The first report of a file may include bytes of an earlier run
+            self.window_bytes += max(0, downloaded - self.reported.get(filename, downloaded))
+            if status["status"] == "downloading":
+                self.reported[filename] = downloaded
+            else:
+                self.reported.pop(filename, None)
+            self._evaluate()
+
+    def error(self):
+        """
+        Report a failed download (including blocked attempts which are retried).
+        """
+        with self.condition:
+            self.window_errors += 1
+            self._evaluate()
+
+    def reset(self):
+        """
+        Try more downloads again, starting from the current number, if no download is running (e.g. the queue has been drained).
+        """
+        with self.condition:
+            if self.active or not self.settled:
+                return
+            self.settled = False
+            self.previous = None
+            self.window_start = time.monotonic()
+            self.window_bytes = 0
+            self.window_errors = 0
+
+    def _settle(self, now):
+        self.settled = True
+        self.settled_at = now
+
+    def _evaluate(self):
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed < self.interval:
+            return
+
+        throughput = self.window_bytes / elapsed
+        errors = self.window_errors
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_errors = 0
+        self.throughput = throughput
+
+        if self.settled and not errors and now - self.settled_at >= self.reprobe_interval:
+            self.settled = False
+            self.previous = None
+
+        if errors:
+            # Multiplicative decrease; more downloads are tried again after self.reprobe_interval
+            workers = max(1, self.workers // 2)
+            if workers != self.workers:
+                self.log(f"{errors} failed downloads, reducing download threads to {workers}")
+            self.workers = workers
+            self.previous = None
+            self._settle(now)
+        elif self.settled or self.active < self.workers:
+            # Not enough downloads left to measure another step
+            return
+        elif self.previous is not None and throughput < self.previous * (1 + self.min_gain):
+            # The last additional download didn't increase the throughput
+            self.workers = max(1, self.workers - 1)
+            self._settle(now)
+            self.log(f"Settled at {self.workers} download threads ({self.previous / 2**20:.2f} MiB/s)")
+        elif self.workers < self.max_workers:
+            self.previous = throughput
+            self.workers += 1
+            self.condition.notify_all()
+        else:
+            self._settle(now)
+            self.log(f"Settled at {self.workers} download threads ({throughput / 2**20:.2f} MiB/s)")
+
+class DownloadScheduler(object):
+    """
+    Process-wide queue for the episode downloads of any number of shows, run by one pool of at most self.max_workers threads
+    which share one DownloadTuner, one SegmentScheduler and one postprocessing executor.
+    The download with the lowest priority runs next; shows whose next downloads have the same priority take turns (round robin),
+    so a long backfill of one show can't delay the new episodes of another one.
+    """
+
+    def __init__(self, max_workers=10, max_connections=16, autotune=True):
+        self.max_workers = max_workers
+        self.tuner = DownloadTuner(max_workers) if autotune else None
+        self.segment_scheduler = SegmentScheduler(max_connections) if max_connections else None
+        # Postprocessing (ffmpeg) runs in its own stage, so self.max_workers only limits the downloads
+        self.postprocess_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+        # show: heap of [priority, order, sequence number, future, function, args]; shows are in round robin order
+        self.queues = OrderedDict()
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.threads = []
+        self.closed = False
+
+    def __len__(self):
+        with self.condition:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def submit(self, show, function, *args, priority=0, order=0):
+        """
+        Queue function(*args) for show and return a Future of its result.
+        Lower priorities run first across all shows, lower orders first within the show.
+        """
+        future = concurrent.futures.Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("DownloadScheduler has been shut down")
+            heapq.heappush(self.queues.setdefault(show, []), [priority, order, next(self.sequence), future, function, args])
+            if len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self._worker, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            self.condition.notify()
+        return future
+
+    def _next(self):
+        # Has to be called with self.condition
+        priority = min(queue[0][0] for queue in self.queues.values())
+        for show, queue in self.queues.items():
+            if queue[0][0] == priority:
+                break
+        item = heapq.heappop(queue)
+        # The show gets its next turn after all other shows with downloads of this priority
+        del self.queues[show]
+        if queue:
+            self.queues[show] = queue
+        return item
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while not self.queues and not self.closed:
+                    self.condition.wait()
+                if not self.queues:
+                    return
+
+            # Wait for a free download slot before choosing the download, so it is chosen with the latest queue
+            if self.tuner:
+                self.tuner.acquire()
+            try:
+                with self.condition:
+                    if not self.queues:
+                        continue
+                    future, function, args = self._next()[3:]
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    result = function(*args)
+                except BaseException as error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            finally:
+                if self.tuner:
+                    self.tuner.release()
+                    with self.condition:
+                        drained = not self.queues
+                    if drained:
+                        self.tuner.reset()
+
+    def shutdown(self):
+        """
+        Wait for all queued downloads and their postprocessing.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        if self.segment_scheduler:
+            self.segment_scheduler.shutdown()
+        self.postprocess_executor.shutdown()
+
+class Telemetry(object):
+    """
+    Download and extraction metrics of all threads, rendered in the Prometheus text format by str(telemetry).
+    Per-episode records and extraction latencies are kept in ring buffers of self.size entries,
+    so the memory used doesn't grow during long runs.
+    """
+
+    PREFIX = "crunchyroll_dl_"
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.lock = threading.Lock()
+
+        # name: value; names may include labels, e.g. 'downloads_total{status="failed"}'
+        self.counters = {}
+        self.gauges = {}
+        # Objects with a metrics() method returning {name: value}, e.g. RateLimiter
+        self.sources = []
+
+        # episode: {"speed", "eta", "downloaded", "total", "retries", "status"}
+        self.episodes = OrderedDict()
+        # Seconds per extraction, the sum and count are kept for all extractions
+        self.extraction_times = deque(maxlen=size)
+
+    def __str__(self):
+        return self.render()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def adjust(self, name, value):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    @contextlib.contextmanager
+    def track(self, name):
+        """
+        Increase the gauge name while the with block is running.
+        """
+        self.adjust(name, 1)
+        try:
+            yield
+        finally:
+            self.adjust(name, -1)
+
+    def extraction(self, seconds, error=False):
+        with self.lock:
+            self.extraction_times.append(seconds)
+            self.counters["extraction_seconds_sum"] = self.counters.get("extraction_seconds_sum", 0) + seconds
+            self.counters["extraction_seconds_count"] = self.counters.get("extraction_seconds_count", 0) + 1
+            if error:
+                self.counters["extraction_errors_total"] = self.counters.get("extraction_errors_total", 0) + 1
+
+    def _episode(self, episode):
+        # Has to be called with self.lock
+        record = self.episodes.get(episode)
+        if record is None:
+            record = self.episodes[episode] = {"speed": 0, "eta": 0, "downloaded": 0, "total": 0, "retries": 0, "status": "queued"}
+        self.episodes.move_to_end(episode)
+        while len(self.episodes) > self.size:
+            self.episodes.popitem(last=False)
+        return record
+
+    def progress(self, episode, status):
+        """
+        Progress hook of youtube-dl for the download of episode.
+        """
+        with self.lock:
+            record = self._episode(episode)
+            downloaded = status.get("downloaded_bytes") or record["downloaded"]
+            self.counters["downloaded_bytes_total"] = self.counters.get("downloaded_bytes_total", 0) + max(0, downloaded - record["downloaded"])
+            record.update({
+                "speed": status.get("speed") or 0,
+                "eta": status.get("eta") or 0,
+                "downloaded": downloaded,
+                "total": status.get("total_bytes") or status.get("total_bytes_estimate") or record["total"],
+                "status": status["status"]
+                })
+
+    def retry(self, episode):
+        with self.lock:
+            self._episode(episode)["retries"] += 1
+            self.counters["download_retries_total"] = self.counters.get("download_retries_total", 0) + 1
+
+    def finish(self, episode, error=False):
+        with self.lock:
+            record = self._episode(episode)
+            record.update({"speed": 0, "eta": 0, "status": "failed" if error else "finished"})
+            name = f'downloads_total{{status="{record["status"]}"}}'
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def render(self):
+        with self.lock:
+            metrics = [*self.counters.items(), *self.gauges.items()]
+            episodes = [(episode, dict(record)) for episode, record in self.episodes.items()]
+            extraction_times = sorted(self.extraction_times)
+        for source in self.sources:
+            metrics.extend(source.metrics().items())
+
+        if extraction_times:
+            for quantile in (0.5, 0.9, 0.99):
+                value = extraction_times[min(len(extraction_times) - 1, int(quantile * len(extraction_times)))]
+                metrics.append((f'extraction_seconds{{quantile="{quantile}"}}', value))
+
+        for episode, record in episodes:
+            label = episode.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            for field, name in (("speed", "speed_bytes"), ("eta", "eta_seconds"), ("downloaded", "downloaded_bytes"),
+                    ("total", "total_bytes"), ("retries", "retries")):
+                metrics.append((f'episode_{name}{{episode="{label}",status="{record["status"]}"}}', record[field]))
+
+        return "".join(f"{self.PREFIX}{name} {value}\n" for name, value in sorted(metrics))
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serve the metrics over HTTP in a background thread.
+        """
+        telemetry = self
+
+        import http.server
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = telemetry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+class InfoTable(object):
+    """
+    Table of the available videos, printed row by row.
+    add() takes the videos in any order (e.g. as callback of Anime.get_info) and prints them in index order
+    as soon as the info of all previous videos is known. At most self.window rows are held back;
+    if more are known ahead of a missing video, they are printed and the missing ones follow once they are known.
+    """
+
+    COLUMNS = ["Index", "Season", "Episode", "Language"]
+
+    def __init__(self, window=100, widths=[5, 6, 7, 8]):
+        self.window = window
+        self.widths = [max(len(name), width) for name, width in zip(self.COLUMNS, widths)]
+
+        # Index of the next row to print; {index: Episode or None} of the videos known ahead of it
+        self.next = 0
+        self.pending = {}
+        self.header = False
+        self.lock = threading.Lock()
+
+    def line(self, values):
+        return "| " + " | ".join(str(value).center(width) for value, width in zip(values, self.widths)) + " |"
+
+    def border(self):
+        return "+" + "+".join("-" * (width + 2) for width in self.widths) + "+"
+
+    def print_row(self, index, episode):
+        """
+        Print the row of a video right away; unavailable and skipped (None) videos have no row.
+        """
+        if not self.header:
+            print(self.border(), self.line(self.COLUMNS), self.border(), sep="\n")
+            self.header = True
+        if episode is not None and episode.available:
+            print(self.line([index, episode.season_number, episode.episode_number, episode.language]))
+
+    def add(self, index, episode):
+        with self.lock:
+            # Missing video of rows which have been printed ahead of it
+            if index < self.next:
+                self.print_row(index, episode)
+                return
+
+            self.pending[index] = episode
+            while self.next in self.pending:
+                self.print_row(self.next, self.pending.pop(self.next))
+                self.next += 1
+
+            if len(self.pending) > self.window:
+                for index in sorted(self.pending):
+                    self.print_row(index, self.pending[index])
+                self.next = index + 1
+                self.pending.clear()
+
+    def close(self):
+        with self.lock:
+            for index in sorted(self.pending):
+                self.print_row(index, self.pending[index])
+            self.pending.clear()
+            if not self.header:
+                self.print_row(0, None)
+            print(self.border())
+
+class Episode(object):
+    """
+    Compact record of a video in anime.config["videos"].
+    Only holds the fields used to list, select and name the episodes; the complete info dict
+    (description, thumbnails, subtitles, formats, ...) is requested again by info() when it is needed.
+    """
+
+    __slots__ = ("url", "playlist_index", "id", "title", "series", "season_number", "episode_number", "episode", "language", "error")
+
+    def __init__(self, url, playlist_index, id=None, title=None, series=None, season_number=None,
+            episode_number=None, episode=None, language=None, error=None):
+        self.url = url
+        self.playlist_index = playlist_index
+        self.id = id
+        self.title = title
+        self.series = series
+        self.season_number = season_number
+        self.episode_number = episode_number
+        self.episode = episode
+        self.language = language
+        self.error = error
+
+    def __repr__(self):
+        return f"Episode({self.playlist_index}, {self.url!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, Episode) and self.to_dict() == other.to_dict()
+
+    @property
+    def available(self):
+        return self.error is None
+
+    @classmethod
+    def from_info(cls, info, url, playlist_index):
+        """
+        Create an episode from an info dict of CrunchyrollIE (or {"error": ...}).
+        """
+        if "error" in info:
+            return cls(url, playlist_index, error=info["error"])
+
+        formats = info.get("formats") or [{}]
+        return cls(
+            url, playlist_index, info.get("id"), info.get("title"), info.get("series"), info.get("season_number"),
+            info.get("episode_number"), info.get("episode"), formats[0].get("language")
+            )
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create an episode from the output of to_dict() or from an info dict stored by older versions.
+        """
+        if "formats" in data:
+            return cls.from_info(data, data.get("url"), data.get("playlist_index"))
+        return cls(**{field: data.get(field) for field in cls.__slots__})
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__ if getattr(self, field) is not None}
+
+    def copy(self, **changes):
+        return Episode(**dict(self.to_dict(), **changes))
+
+    def info(self, anime):
+        """
+        Returns the complete info dict of this episode (from anime.cache if possible).
+        """
+        return anime.video_info(self.playlist_index, self.url)[1]
+
+class MetadataEngine(object):
+    """
+    Extracts the info of many videos from an asyncio event loop.
+    The extractor itself is blocking, so at most self.concurrency extractions run in a thread pool of the same size.
+    One engine can extract the videos of several anime at once; they share its concurrency.
+    """
+
+    def __init__(self, concurrency=50, probe_depth=0):
+        self.concurrency = concurrency
+        # Levels of middles requested between two unavailable videos before the videos between them are skipped;
+        # with 0, a sequence whose first video is unavailable is skipped entirely
+        self.probe_depth = probe_depth
+        self.semaphore = None
+        self.executor = None
+
+    def run(self, coroutine):
+        """
+        Run coroutine (e.g. self.extract()) in a new event loop and return its result.
+        """
+        return asyncio.run(self._run(coroutine))
+
+    async def _run(self, coroutine):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            return await coroutine
+        finally:
+            self.executor.shutdown()
+
+    async def call(self, function, *args):
+        """
+        Run the blocking function in the thread pool once one of self.concurrency slots is free.
+        """
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def gather(self, coroutines):
+        """
+        Run coroutines concurrently; returns their results or the exceptions they raised in the same order.
+        """
+        return await asyncio.gather(*coroutines, return_exceptions=True)
+
+    async def video_info(self, anime, index, url):
+        anime.telemetry.adjust("extraction_queue", 1)
+        async with self.semaphore:
+            anime.telemetry.adjust("extraction_queue", -1)
+            index, info = await asyncio.get_running_loop().run_in_executor(self.executor, anime.video_info, index, url)
+        return Episode.from_info(info, url, index)
+
+    async def extract(self, anime, urls, check_all=False, callback=None, known={}):
+        """
+        Returns {index: Episode} for all videos in urls which were checked.
+        Unless check_all is set, the first episode of every video sequence is requested first; if it is unavailable,
+        the rest of the sequence is skipped unless self.probe_depth is set. Otherwise the last episode is requested as well.
+        Episodes are locked in ranges (e.g. premium only episodes at the end of a sequence), so the rest is bisected:
+        the videos between two available ones are all requested and between an available and an unavailable one the middle
+        is requested next. Between two unavailable ones, one middle is requested and, if an available video of the sequence
+        is known after them (so they aren't just the locked end of it), further middles up to self.probe_depth levels deep,
+        before the remaining ones are skipped.
+        Videos in known ({index: Episode}) aren't requested again.
+        callback(index, episode) is called for every video as soon as its info is available; episode is None for skipped videos.
+        """
+        entries = {}
+
+        async def get(index):
+            if index in known:
+                entries[index] = known[index]
+            else:
+                entries[index] = await self.video_info(anime, index, urls[index])
+            if callback:
+                callback(index, entries[index])
+            return entries[index]
+
+        async def get_range(indices, first, last, depth=0):
+            """
+            Get the videos of indices between the positions first and last, which have been requested already.
+            depth is the number of middles between unavailable videos requested so far.
+            """
+            if last - first < 2:
+                return
+            first_available = entries[indices[first]].available
+            last_available = entries[indices[last]].available
+            if first_available and last_available:
+                await asyncio.gather(*[get(index) for index in indices[first + 1:last]])
+                return
+            if not (first_available or last_available):
+                available_after = any(entries[index].available for index in indices[last + 1:] if index in entries)
+                if not (depth < self.probe_depth and (depth == 0 or available_after)):
+                    # Assumed to be unavailable as well
+                    anime.telemetry.count("extractions_skipped_total", last - first - 1)
+                    if callback:
+                        for index in indices[first + 1:last]:
+                            callback(index, None)
+                    return
+                depth += 1
+            middle = (first + last) // 2
+            await get(indices[middle])
+            await asyncio.gather(get_range(indices, first, middle, depth), get_range(indices, middle, last, depth))
+
+        async def get_sequence(indices):
+            if check_all or len(indices) < 3:
+                await asyncio.gather(*[get(index) for index in indices])
+                return
+            if not (await get(indices[0])).available and not self.probe_depth:
+                anime.telemetry.count("extractions_skipped_total", len(indices) - 1)
+                if callback:
+                    for index in indices[1:]:
+                        callback(index, None)
+                return
+            await get(indices[-1])
+            await get_range(indices, 0, len(indices) - 1)
+
+        await asyncio.gather(*[get_sequence(indices) for indices in split_sequences(urls)])
+        return entries
+
+class SegmentScheduler(object):
+    """
+    Fixed budget of connections shared by all episodes of a batch.
+    Segments of every episode are fetched by the same pool of workers, so the last episodes of a batch
+    still use every connection.
+    """
+
+    def __init__(self, connections=16):
+        self.connections = connections
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=connections)
+
+    def submit(self, function, *args):
+        return self.executor.submit(function, *args)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections, shared by all threads.
+    """
+
+    def __init__(self, max_idle=16):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.created = 0
+        self.reused = 0
+
+    def get(self, key):
+        with self.lock:
+            if self.idle.get(key):
+                self.reused += 1
+                return self.idle[key].pop()
+            self.created += 1
+            return None
+
+    def put(self, key, connection):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+class KeepAliveMixin(object):
+    """
+    Replaces do_open of urllib's HTTP handlers, which closes the connection after every request,
+    with one that returns connections to self.pool once their response has been read completely.
+    """
+
+    pool = None
+
+    def do_open(self, http_class, req, **http_conn_args):
+        if not req.host:
+            raise urllib.error.URLError("no host given")
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers["Connection"] = "keep-alive"
+        headers = {name.title(): val for name, val in headers.items()}
+        tunnel_headers = {}
+        if req._tunnel_host and "Proxy-Authorization" in headers:
+            # Proxy-Authorization should not be sent to origin server
+            tunnel_headers["Proxy-Authorization"] = headers.pop("Proxy-Authorization")
+
+        key = (type(self).__name__, req.host, req._tunnel_host)
+        connection = self.pool.get(key)
+        while True:
+            reused = connection is not None
+            if not reused:
+                connection = http_class(req.host, timeout=req.timeout, **http_conn_args)
+                connection.set_debuglevel(self._debuglevel)
+                if req._tunnel_host:
+                    connection.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            try:
+                connection.request(req.get_method(), req.selector, req.data, headers,
+                    encode_chunked=req.has_header("Transfer-encoding"))
+                response = connection.getresponse()
+                break
+            except ConnectionError as err:
+                connection.close()
+                # The server has closed the idle connection; try again with a new one
+                if not reused:
+                    raise urllib.error.URLError(err)
+                connection = None
+            except OSError as err:
+                connection.close()
+                raise urllib.error.URLError(err)
+            except:
+                connection.close()
+                raise
+
+        if not response.will_close:
+            if response.isclosed():
+                self.pool.put(key, connection)
+            else:
+                close_conn = response._close_conn
+
+                def release():
+                    # Only a completely read response leaves the connection in a usable state
+                    complete = response.length == 0
+                    close_conn()
+                    if complete:
+                        self.pool.put(key, connection)
+                    else:
+                        connection.close()
+                response._close_conn = release
+
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+class Session(object):
+    """
+    Cookie jar, keep-alive connections and Crunchyroll login shared by every Downloader and its information extractors.
+    """
+
+    # Parameters of YoutubeDL which are used to build its opener
+    OPENER_PARAMS = ["cookiefile", "proxy", "socket_timeout", "source_address", "nocheckcertificate", "debug_printtraffic"]
+
     def __init__(self):
-        self.downloader = youtube_dl.YoutubeDL()
-        # Create reference to config
-        self.ytdl_config = self.downloader.params
+        self.pool = ConnectionPool()
+        self.cookiejars = {}
+        self.openers = {}
+        self.lock = threading.Lock()
+        self.logged_in = False
+        self.login_lock = threading.Lock()
+
+        # Statistics
+        self.logins = 0
+        self.downloaders = 0
+
+    def __str__(self):
+        return (f"Logins: {self.logins}, downloaders: {self.downloaders}, "
+            f"connections: {self.pool.created} opened, {self.pool.reused} reused")
+
+    def setup_opener(self, downloader):
+        """
+        Replacement for YoutubeDL._setup_opener; downloaders with the same opener parameters share one opener.
+        """
+        params = downloader.params
+        key = tuple(str(params.get(param)) for param in self.OPENER_PARAMS)
 
-        # Information extractors
-        ## ie._downloader.params are a reference to self.downloader.params
-        self.playlist_ie = youtube_dl.extractor.crunchyroll.CrunchyrollShowPlaylistIE(self.downloader)
-        self.ie = youtube_dl.extractor.crunchyroll.CrunchyrollIE(self.downloader) 
+        with self.lock:
+            if key not in self.openers:
+                self.openers[key] = self.build_opener(params)
+            downloader.cookiejar, downloader._opener = self.openers[key]
+            downloader._socket_timeout = 600 if params.get("socket_timeout") is None else float(params["socket_timeout"])
 
-        # Default ytdl config
-        self.ytdl_config.update({
+    def build_opener(self, params):
+        """
+        Same as YoutubeDL._setup_opener, but with keep-alive HTTP handlers and cookie jars shared per cookie file.
+        """
+        cookiefile = params.get("cookiefile")
+        if cookiefile not in self.cookiejars:
+            if cookiefile is None:
+                self.cookiejars[cookiefile] = youtube_dl.compat.compat_cookiejar.CookieJar()
+            else:
+                cookiejar = youtube_dl.utils.YoutubeDLCookieJar(youtube_dl.utils.expand_path(cookiefile))
+                if os.access(cookiejar.filename, os.R_OK):
+                    cookiejar.load(ignore_discard=True, ignore_expires=True)
+                self.cookiejars[cookiefile] = cookiejar
+        cookiejar = self.cookiejars[cookiefile]
+
+        if params.get("proxy") is not None:
+            proxies = {} if params["proxy"] == "" else {"http": params["proxy"], "https": params["proxy"]}
+        else:
+            proxies = urllib.request.getproxies()
+            if "http" in proxies and "https" not in proxies:
+                proxies["https"] = proxies["http"]
+
+        debuglevel = 1 if params.get("debug_printtraffic") else 0
+        https_handler = youtube_dl.utils.make_HTTPS_handler(params, debuglevel=debuglevel)
+        https_handler = ytdl.KeepAliveHTTPSHandler(params, context=https_handler._context, debuglevel=debuglevel)
+        https_handler.pool = self.pool
+        http_handler = ytdl.KeepAliveHTTPHandler(params, debuglevel=debuglevel)
+        http_handler.pool = self.pool
+
+        # Disable the file protocol like youtube-dl does
+        file_handler = urllib.request.FileHandler()
+        def file_open(*args, **kwargs):
+            raise urllib.error.URLError("file:// scheme is explicitly disabled in youtube-dl for security reasons")
+        file_handler.file_open = file_open
+
+        opener = urllib.request.build_opener(
+            youtube_dl.utils.PerRequestProxyHandler(proxies), https_handler, youtube_dl.utils.YoutubeDLCookieProcessor(cookiejar),
+            http_handler, youtube_dl.utils.YoutubeDLRedirectHandler(), urllib.request.DataHandler(), file_handler)
+        opener.addheaders = []
+        return cookiejar, opener
+
+    def init_extractor(self, ie):
+        """
+        Make sure only the first Crunchyroll extractor logs in; the others use its cookies.
+        """
+        if not isinstance(ie, youtube_dl.extractor.crunchyroll.CrunchyrollBaseIE):
+            return
+        login = ie._login
+
+        def _login():
+            with self.login_lock:
+                if self.logged_in:
+                    return
+                login()
+                self.logged_in = True
+                if ie._get_login_info()[0] is not None:
+                    self.logins += 1
+        ie._login = _login
+
+def load_youtube_dl():
+    """
+    Import youtube_dl and ytdl.py with the classes based on it (Downloader, SegmentedHlsFD, KeepAliveHTTPHandler, KeepAliveHTTPSHandler).
+    Called by everything that needs youtube_dl, so operations without it (e.g. listing the stored anime) start fast.
+    Returns the youtube_dl module.
+    """
+    global youtube_dl, ytdl
+    with youtube_dl_lock:
+        if ytdl is None:
+            # Only if youtube_dl hasn't been imported with all extractors already
+            if "youtube_dl" not in sys.modules:
+                sys.modules["youtube_dl.extractor.lazy_extractors"] = ExtractorRegistry()
+            import youtube_dl
+            import ytdl
+    return youtube_dl
+
+class ExtractorRegistry(types.ModuleType):
+    """
+    Stands in for youtube_dl.extractor.lazy_extractors (only part of builds of youtube-dl made with make_lazy_extractors.py),
+    so importing youtube_dl only imports the extractors in self.EXTRACTORS instead of the several hundred of its registry.
+    """
+
+    # Class name: module in youtube_dl.extractor
+    EXTRACTORS = {
+        "CrunchyrollIE": "crunchyroll",
+        "CrunchyrollShowPlaylistIE": "crunchyroll"
+    }
+
+    def __init__(self):
+        super().__init__("youtube_dl.extractor.lazy_extractors")
+        self.__all__ = list(self.EXTRACTORS)
+
+    def __getattr__(self, name):
+        if name in self.EXTRACTORS:
+            value = getattr(importlib.import_module("youtube_dl.extractor." + self.EXTRACTORS[name]), name)
+        elif name == "_ALL_CLASSES":
+            value = [getattr(self, extractor) for extractor in self.EXTRACTORS]
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+class DownloadCancelled(Exception):
+    """
+    Raised by a hook in Anime.progress_hooks to stop a download, e.g. of a worker which lost its lease.
+    """
+
+class Anime():
+    def __init__(self, session=None):
+        # Shared by self.downloader and every download
+        self.session = session or Session()
+
+        # Created with the first access of self.downloader, so youtube_dl is only imported if it is needed
+        self._downloader = None
+        self.downloader_lock = threading.Lock()
+
+        # Default ytdl config; becomes a reference to self.downloader.params once the downloader has been created
+        self.ytdl_config = {
+            "session": self.session,
             "postprocessors": [{"key": "FFmpegEmbedSubtitle"}],
             "ignoreerrors": True,
             "nooverwrites": True,
             "allsubtitles": True,
             "writesubtitles": True,
             "continuedl": True,
-            })
+            }
 
         # Default config
         self.config = {
@@ -83,16 +1549,85 @@ class Anime():
         self.check_all = False
         self.max_threads = 50
         self.max_dl_threads = 10
+        # Adjust the number of download threads (up to self.max_dl_threads) to the bandwidth
+        self.autotune = True
+        # Connections shared by all download threads for HLS segments; 0 uses the downloaders of youtube-dl
+        self.max_connections = 16
         self.use_filedialog = False
 
         # Current download threads
         self.dl_threads = []
+        # Open batch of downloads; see open_batch()
+        self.batch = None
+
+        # MetadataCache instance; None disables caching
+        self.cache = None
+        # SubtitleStore instance to reuse subtitles of earlier downloads from; None fetches every subtitle
+        self.subtitles = None
+        # Shared by metadata extraction and downloads
+        self.limiter = RateLimiter(concurrency=self.max_threads)
+        # DownloadScheduler shared with other Anime instances; None runs every batch with its own scheduler
+        self.scheduler = None
+        # Downloads of batches with lower priorities run first; see DownloadScheduler
+        self.priority = 0
+        self.newest_first = True
+        # DownloadTuner of the current batch
+        self.tuner = None
+        # Shared by all Anime instances if metrics are served
+        self.telemetry = Telemetry()
+
+        # StateStore to checkpoint finished episodes and partial downloads in; None disables checkpoints
+        self.state = None
+        # Seconds between checkpoints of the progress of a download
+        self.checkpoint_interval = 5
+        # Called with the index of every episode as soon as it has been downloaded and postprocessed
+        self.on_finished = None
+        # Additional progress hooks of every download; they may raise DownloadCancelled
+        self.progress_hooks = []
+        # Guards self.config["downloaded"] and self.batch
+        self.lock = threading.Lock()
+
+    @property
+    def downloader(self):
+        with self.downloader_lock:
+            if self._downloader is None:
+                load_youtube_dl()
+                self._downloader = ytdl.Downloader(self.ytdl_config)
+                # Create reference to config
+                self.ytdl_config = self._downloader.params
+                # Instantiate the information extractors before they are used by several threads
+                self._downloader.get_info_extractor("CrunchyrollShowPlaylist")
+                self._downloader.get_info_extractor("Crunchyroll")
+        return self._downloader
+
+    # Information extractors
+    ## ie._downloader.params are a reference to self.downloader.params
+    @property
+    def playlist_ie(self):
+        return self.downloader.get_info_extractor("CrunchyrollShowPlaylist")
+
+    @property
+    def ie(self):
+        return self.downloader.get_info_extractor("Crunchyroll")
 
     def video_info(self, index, url):
+        if self.cache:
+            info = self.cache.get(url)
+            if info is not None:
+                self.telemetry.count("cache_hits_total")
+                return (index, info)
+
+        start = time.monotonic()
         try:
-            return (index, self.ie._real_extract(url))
+            info = self.limiter.call(self.ie._real_extract, url)
         except (youtube_dl.utils.DownloadError, youtube_dl.utils.ExtractorError) as error:
-            return (index, {"error": str(error)})
+            info = {"error": str(error)}
+        self.telemetry.extraction(time.monotonic() - start, "error" in info)
+
+        # Blocked requests say nothing about the availability of the video
+        if self.cache and not is_blocked(info.get("error", "")):
+            self.cache.put(url, info)
+        return (index, info)
 
     def update_config(self):
         """
@@ -113,185 +1648,1111 @@ class Anime():
         # Update config with custom values
         self.ytdl_config.update(self.config["custom"])
 
+        # Use an opener matching the new config (e.g. proxy) for the information extractors
+        self.session.setup_opener(self.downloader)
+
     def print_info(self):
         if not self.config["videos"]:
             self.get_info()
 
-        table = PrettyTable(["Index", "Season", "Episode", "Language"])
-
-        skip_part = False
-        for index, video_dict in sorted(self.config["videos"].items(), key=lambda x: int(x[0])):
-            if "/episode-1-" in video_dict["url"]:
-                skip_part = True if "error" in video_dict else False
-                if not skip_part:
-                    table.add_row([index, video_dict["season_number"], video_dict["episode_number"], video_dict["formats"][0]["language"]])
-            elif not skip_part:
-                if not "error" in video_dict:
-                    table.add_row([index, video_dict["season_number"], video_dict["episode_number"], video_dict["formats"][0]["language"]])
+        table = InfoTable()
+        # Videos which were skipped by get_info aren't in self.config["videos"]
+        for index, episode in sorted(self.config["videos"].items(), key=lambda x: int(x[0])):
+            table.print_row(index, episode)
+        table.close()
 
-        print(table)
 
+    def get_urls(self, prompt=True):
+        """
+        Returns the URLs of all videos of the playlist.
+        If the playlist can't be accessed and prompt is set, the user is asked for a manually downloaded page.
+        """
+        if self.config.get("html_path"):
+            return flattened_list(load_urls_from_html(self.config["html_path"]))
 
-    def get_info(self):
+        try:
+            playlist_ie_return = self.limiter.call(self.playlist_ie._real_extract, self.config["url"])
+            return [entry["url"] for entry in playlist_ie_return["entries"]]
+        # Workaround - HTTP Error 403
+        except youtube_dl.utils.ExtractorError:
+            if not prompt:
+                raise
+            print(f"Could not access {self.config['url']}. Please download the page manually.")
+            self.config["html_path"] = get_path(["cr.html", "cr.htm"], self.use_filedialog, msg="Please enter the path of the html file > ")
+            return flattened_list(load_urls_from_html(self.config["html_path"]))
+
+    def get_info(self, callback=None, urls=None, known={}):
         """
         Creates self.config["title"], self.config["id"] and self.config["videos"]
-        self.config["videos"][index]: "_type", "url", "ie_key", "id", "title", "description", "duration", "thumbnail", "uploader", "series", "season", "episode", "episode_number", "subtitles", "formats", "season_number", "timestamp"
+        callback(index, episode) is called for every video as soon as its info is available (episode is None for skipped videos);
+        self.config["title"] is set before it is called for the first available video
+        urls are the URLs of the playlist (requested if not given); videos in known ({index: Episode}) aren't requested again
+        self.config["videos"][index]: Episode; the complete info dict is available with Episode.info(self)
         """
 
+        engine = MetadataEngine(self.max_threads)
+        engine.run(self.extract_info(engine, callback, urls, known))
+
+    async def extract_info(self, engine, callback=None, urls=None, known={}, prompt=True):
+        """
+        get_info() with the given MetadataEngine, e.g. shared with other anime.
+        """
         self.update_config()
-        playlist_info = {}
+        if urls is None:
+            urls = await engine.call(self.get_urls, prompt)
 
-        # Get basic playlist info
-        if not self.config.get("html_path"):
-            try:
-                playlist_ie_return = self.playlist_ie._real_extract(self.config["url"])
-                playlist_info.update({
-                    "title": playlist_ie_return["title"],
-                    "id": playlist_ie_return["id"],
-                    "urls": [entry["url"] for entry in playlist_ie_return["entries"]]
-                    })
-            # Workaround - HTTP Error 403
-            except youtube_dl.utils.ExtractorError:
-                print(f"Could not access {self.config['url']}. Please download the page manually.")
-                self.config["html_path"] = get_path(["cr.html", "cr.htm"], self.use_filedialog, msg="Please enter the path of the html file > ")
-                playlist_info.update({
-                    "urls": flattened_list(load_urls_from_html(self.config["html_path"]))
+        def found(index, episode):
+            # Set tile and an unique id if not already set, so episodes can be downloaded before the others are known
+            if episode is not None and not (self.config["title"] and self.config["id"]):
+                if episode.series is not None and episode.id is not None:
+                    self.config.update({
+                        "title": episode.series,
+                        "id": episode.id
                     })
-        else:
-            playlist_info.update({"urls": flattened_list(load_urls_from_html(self.config["html_path"]))})
-
-        # Check which parts of the playlist are available to the user (to reduce requests)
-        # The playlist_info["urls"] list are is sorted by language and season
-        # Each season / sequence of episodes in one language begins with "/episode-1-" in its URL
-        if not self.check_all:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-                threads = []
-                for index, url in enumerate(playlist_info["urls"]):
-                    if "/episode-1-" in url:
-                        thread = executor.submit(self.video_info, index, url)
-                        threads.append(thread)
-                playlist_info["entries"] = {}
-                for thread in concurrent.futures.as_completed(threads):
-                    result = thread.result()
-                    # result[0] contains the index to the corresponding element in playlist_info["urls"],
-                    # result[1] the data from self.video_info()
-                    playlist_info["entries"].update({
-                        result[0]: result[1]
-                        })
-                    playlist_info["entries"][result[0]].update({
-                        "url": playlist_info["urls"][result[0]]
-                        })
+            if callback:
+                callback(index, episode)
 
         # Get detailed infos about the videos
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            threads = []
-            skip_part = False
-            for index, url in enumerate(playlist_info["urls"]):
-                # Skip because the info about the fist episodes of each video
-                # sequence was already gathered (if self.check_all is False)
-                if not self.check_all and "/episode-1-" in url:
-                    # If there has been an error, skip the rest of the sequence
-                    if not "error" in playlist_info["entries"].get(index):
-                        skip_part = False
-                        thread = executor.submit(self.video_info, index, url)
-                        threads.append(thread)
-                    else:
-                        skip_part = True
-                elif not skip_part:
-                    thread = executor.submit(self.video_info, index, url)
-                    threads.append(thread)
-            for thread in concurrent.futures.as_completed(threads):
-                result = thread.result()
-                # result[0] contains the index to the corresponding element in playlist_info["urls"],
-                # result[1] the data from self.video_info()
-                playlist_info["entries"].update({
-                    result[0]: result[1]
-                    })
-                playlist_info["entries"][result[0]].update({
-                    "url": playlist_info["urls"][result[0]],
-                    "playlist_index": result[0]
-                    })
-                if not "error" in result[1]:
-                    del playlist_info["entries"][result[0]]["formats"][1:]
+        entries = await engine.extract(self, urls, self.check_all, found, known)
 
         # Save to config
-        self.config.update({"videos": playlist_info["entries"]})
+        self.config.update({"videos": entries})
+        if self.cache:
+            self.cache.save()
 
-        # Set tile and an unique id if not already set
-        if not (self.config["title"] and self.config["id"]):
-            for index, video in playlist_info["entries"].items():
-                if "series" in video.keys() and "id" in video.keys():
-                    self.config.update({
-                        "title": playlist_info["entries"][index]["series"],
-                        "id": playlist_info["entries"][index]["id"]
-                    })
-                    break
+    def sync(self, refresh=False):
+        """
+        Update self.config["videos"] to the current playlist; only videos which weren't available before are requested
+        unless refresh is set.
+        Returns the indices of the newly available videos and a dict of old index: new index.
+        """
+        engine = MetadataEngine(self.max_threads)
+        return engine.run(self.extract_sync(engine, refresh))
 
-    def start_download(self, dl_index):
+    async def extract_sync(self, engine, refresh=False):
+        """
+        sync() with the given MetadataEngine, e.g. shared with other anime.
+        """
         self.update_config()
+        urls = await engine.call(self.get_urls, False)
+
+        old_videos = self.config["videos"] or {}
+        old_index = {remove_lang_tag(episode.url): index for index, episode in old_videos.items()}
+
+        # Indices are positions in the playlist, so they change if episodes were added in front of other ones
+        remap = {}
+        known = {}
+        available = set()
+        for index, url in enumerate(urls):
+            if remove_lang_tag(url) in old_index:
+                remap[old_index[remove_lang_tag(url)]] = index
+                episode = old_videos[old_index[remove_lang_tag(url)]]
+                # Unavailable videos are checked again (as far as the cache allows)
+                if episode.available:
+                    available.add(index)
+                    if not refresh:
+                        known[index] = episode.copy(url=url, playlist_index=index)
+
+        await self.extract_info(engine, urls=urls, known=known)
+
+        self.config["downloaded"] = sorted(remap[index] for index in self.config.get("downloaded", []) if index in remap)
+        new = sorted(index for index, episode in self.config["videos"].items() if index not in available and episode.available)
+        return new, remap
 
-        dl_videos = [self.config["videos"][index] for index in dl_index]
+    def start_download(self, dl_index):
+        """
+        Download the episodes in dl_index with self.scheduler (or a scheduler of its own) and wait for them and their postprocessing.
+        Episodes which have already been queued in the open batch (see open_batch()) aren't queued again.
+        """
+        self.open_batch()
+        # dl_index may be changed by self.on_finished meanwhile
+        for index in list(dl_index):
+            self.queue_download(self.config["videos"][index])
+        self.close_batch()
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_dl_threads) as executor:
-            for video_dict in dl_videos:
-                thread = executor.submit(self._download, video_dict)
-                self.dl_threads.append(thread)
+    def open_batch(self):
+        """
+        Prepare a batch of downloads, so episodes can be queued with queue_download() one by one, e.g. as soon as their info is available.
+        """
+        if self.batch is not None:
+            return
+        self.update_config()
 
-    def _download(self, video_dict):
+        scheduler = self.scheduler or DownloadScheduler(self.max_dl_threads, self.max_connections, self.autotune)
+        self.tuner = scheduler.tuner
+        self.ytdl_config.update({
+            "segment_scheduler": scheduler.segment_scheduler,
+            "postprocess_executor": scheduler.postprocess_executor,
+            "subtitle_store": self.subtitles,
+            "limiter": self.limiter,
+            "telemetry": self.telemetry
+            })
+        # Scheduler and {index: future} of the queued downloads
+        self.batch = (scheduler, {})
+
+    def queue_download(self, episode):
+        scheduler, threads = self.batch
+        with self.lock:
+            if episode.playlist_index in threads:
+                return
+            self.telemetry.adjust("download_queue", 1)
+            order = -episode.playlist_index if self.newest_first else episode.playlist_index
+            threads[episode.playlist_index] = scheduler.submit(self.config["title"], self._download, episode, priority=self.priority, order=order)
+            self.dl_threads.append(threads[episode.playlist_index])
+
+    def close_batch(self):
+        """
+        Wait for the downloads of the batch and their postprocessing.
+        """
+        scheduler, threads = self.batch
+        if self.scheduler is None:
+            scheduler.shutdown()
+        else:
+            threads = list(threads.values())
+            concurrent.futures.wait(threads)
+            concurrent.futures.wait([thread.result() for thread in threads if not thread.exception() and thread.result()])
+        self.batch = None
+
+        del self.ytdl_config["segment_scheduler"]
+        del self.ytdl_config["postprocess_executor"]
+        del self.ytdl_config["limiter"]
+        if self.subtitles:
+            self.subtitles.save()
+
+    def _download(self, episode):
         ytdl_config = self.ytdl_config.copy()
-        ytdl_config["outtmpl"] = ytdl_config["outtmpl"].replace("%(playlist_index)s", str(video_dict['playlist_index']))
+        ytdl_config["outtmpl"] = ytdl_config["outtmpl"].replace("%(playlist_index)s", str(episode.playlist_index))
+
+        # Errors have to be raised to be able to retry blocked downloads; they are still reported by the logger
+        ytdl_config["ignoreerrors"] = False
+
+        name = f"{self.config['title']} [{episode.playlist_index}]"
+
+        # Checkpoint the episode as soon as it has been postprocessed in params["postprocess_executor"]
+        ytdl_config["postprocessed_hook"] = lambda: self._finished(episode)
 
         # Create a new downloader object with copy of current config and self._hook as hook
-        downloader = youtube_dl.YoutubeDL(ytdl_config)
-        downloader.params.update({"progress_hooks": [self._hook]})
+        # (YoutubeDL registers params["progress_hooks"] when it is created)
+        ytdl_config["progress_hooks"] = [
+            *self.progress_hooks,
+            self._hook,
+            lambda status: self.telemetry.progress(name, status),
+            self._progress_checkpoint(episode)
+            ]
+        downloader = ytdl.Downloader(ytdl_config)
+
+        attempts = 0
+        def download(url):
+            nonlocal attempts
+            attempts += 1
+            if attempts > 1:
+                self.telemetry.retry(name)
+            try:
+                return downloader.download([url])
+            except youtube_dl.utils.DownloadError:
+                if self.tuner:
+                    self.tuner.error()
+                raise
 
-        downloader.download([video_dict["url"]])
+        self.telemetry.adjust("download_queue", -1)
+        try:
+            with self.telemetry.track("downloads_active"):
+                # A download runs for minutes, so it doesn't hold one of the concurrent requests of the limiter
+                self.limiter.call(download, episode.url, slot=False)
+        except (youtube_dl.utils.DownloadError, DownloadCancelled):
+            self.telemetry.finish(name, error=True)
+        else:
+            self.telemetry.finish(name)
+            if not downloader.postprocessed:
+                self._finished(episode)
+        # Future of the postprocessing, if it is still running
+        return downloader.postprocessed
+
+    def _progress_checkpoint(self, episode):
+        """
+        Returns a progress hook storing the partial download of episode every self.checkpoint_interval seconds.
+        """
+        last = 0
+
+        def hook(status):
+            nonlocal last
+            if not self.state or status["status"] != "downloading" or time.monotonic() - last < self.checkpoint_interval:
+                return
+            last = time.monotonic()
+            self.state.save_progress(
+                self.config["title"], episode.playlist_index,
+                status.get("tmpfilename") or status.get("filename"), status.get("downloaded_bytes") or 0
+                )
+
+        return hook
+
+    def _finished(self, episode):
+        """
+        Checkpoint episode as downloaded.
+        """
+        with self.lock:
+            if episode.playlist_index not in self.config["downloaded"]:
+                self.config["downloaded"].append(episode.playlist_index)
+            if self.state:
+                self.state.save_anime(self.config)
+                self.state.delete_progress(self.config["title"], episode.playlist_index)
+        if self.on_finished:
+            self.on_finished(episode.playlist_index)
 
     def _hook(self, downloader):
+        if self.tuner:
+            self.tuner.progress(downloader)
         if downloader["status"] == "finished":
             print(f"Finished downloading ", os.path.basename(downloader["filename"]))
 
+class Daemon(object):
+    """
+    Processes download jobs without user interaction.
+    Jobs are read from a JSON lines file and/or a unix socket and stored in the config database before they are processed,
+    so jobs which were interrupted get processed again after a restart.
+    Every job is a JSON object: {"url" or "title", "episodes" (e.g. "1-12,15"; all undownloaded by default), "output" (optional),
+    "priority" (optional; jobs and downloads with lower priorities run first, 1 by default)}
+    At most self.max_jobs jobs are prepared (info requested, session saved) at once; their downloads are then queued in the
+    shared DownloadScheduler and the next job is started, so the priorities of new jobs apply to the downloads of running ones.
+    """
+
+    def __init__(self, config, state, arguments=[], verbosity=1, cache=None):
+        self.config = config
+        self.state = state
+        self.arguments = arguments
+        self.verbosity = verbosity
+        self.cache = cache
+        # SubtitleStore shared by all jobs
+        self.subtitles = None
+
+        self.jobs_path = None
+        self.socket_path = None
+        self.max_jobs = 2
+        self.poll_interval = 5
+        # Set when a job has been added or has queued its downloads
+        self.wake = threading.Event()
+
+        # Shared by all jobs
+        self.session = Session()
+        self.limiter = RateLimiter()
+        # Created by run() with the final config
+        self.scheduler = None
+        self.telemetry = Telemetry()
+        self.telemetry.sources.extend([self.limiter, self])
+        # Port to distribute the downloads to workers on (see Coordinator); None downloads them in this process
+        self.coordinator_port = None
+        self.coordinator = None
+        # Guards self.config
+        self.lock = threading.RLock()
+
+    def metrics(self):
+        return {f'jobs{{status="{status}"}}': count for status, count in self.state.job_counts().items()}
+
+    def run(self):
+        requeued = self.state.requeue_jobs()
+        if requeued:
+            print(f"Resuming {requeued} interrupted job(s)")
+
+        if self.socket_path:
+            threading.Thread(target=self.serve, daemon=True).start()
+
+        if self.coordinator_port:
+            self.coordinator = Coordinator(telemetry=self.telemetry)
+            self.coordinator.serve(self.coordinator_port)
+            print(f"Waiting for workers on port {self.coordinator_port}")
+
+        # The downloads of all jobs share the download threads and HLS connections
+        self.scheduler = DownloadScheduler(self.config["general"]["max_dl_threads"], self.config["general"]["max_connections"])
+
+        preparing = threading.Semaphore(self.max_jobs)
+        while True:
+            self.wake.clear()
+            if self.jobs_path:
+                self.read_jobs_file()
+
+            while preparing.acquire(blocking=False):
+                job = self.state.next_job()
+                if job is None:
+                    preparing.release()
+                    break
+                threading.Thread(target=self.run_job, args=(*job, preparing), daemon=True).start()
+
+            self.wake.wait(self.poll_interval)
+
+    def add_job(self, spec):
+        if not isinstance(spec, dict) or not (spec.get("url") or spec.get("title")):
+            raise ValueError("A job needs a url or title")
+        job_id = self.state.add_job(spec)
+        print(f"Queued job {job_id}:", spec.get("title") or spec.get("url"))
+        self.wake.set()
+        return job_id
+
+    def read_jobs_file(self):
+        """
+        Move all jobs from self.jobs_path to the database.
+        """
+        reading_path = self.jobs_path + ".reading"
+        # A file left over by a daemon which stopped while reading it is read first, so its jobs aren't overwritten
+        # (jobs which were already added before it stopped are added again)
+        if not os.path.exists(reading_path):
+            try:
+                os.replace(self.jobs_path, reading_path)
+            except FileNotFoundError:
+                return
+
+        with open(reading_path, "r", encoding="utf-8") as jobs_file:
+            for line in jobs_file:
+                if line.strip():
+                    try:
+                        self.add_job(json.loads(line))
+                    except ValueError as e:
+                        print("Invalid job:", line.strip(), e)
+        os.remove(reading_path)
+
+        # Jobs written in the meantime
+        if os.path.exists(self.jobs_path):
+            self.read_jobs_file()
+
+    def serve(self):
+        """
+        Accept jobs on a unix socket; every line is a job, every job is answered with {"id": ...} or {"error": ...}.
+        """
+        daemon = self
+
+        class JobHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = {"id": daemon.add_job(json.loads(line))}
+                    except ValueError as e:
+                        response = {"error": str(e)}
+                    self.wfile.write((json.dumps(response) + "\n").encode())
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        with socketserver.ThreadingUnixStreamServer(self.socket_path, JobHandler) as server:
+            server.serve_forever()
+
+    def run_job(self, job_id, spec, preparing):
+        """
+        Process the job; preparing is released as soon as its downloads have been queued (or it failed before).
+        """
+        released = False
+        def queued():
+            nonlocal released
+            if not released:
+                released = True
+                preparing.release()
+                self.wake.set()
+
+        try:
+            self.process(spec, queued)
+        except Exception as e:
+            print(f"Job {job_id} failed:", e)
+            self.state.finish_job(job_id, str(e) or type(e).__name__)
+        else:
+            print(f"Job {job_id} finished")
+            self.state.finish_job(job_id)
+        finally:
+            queued()
+
+    def process(self, spec, queued=None):
+        """
+        Download the episodes of the job spec; queued() is called once they have been queued.
+        """
+        anime = Anime(self.session)
+        anime.cache = self.cache
+        anime.subtitles = self.subtitles
+        anime.limiter = self.limiter
+        anime.scheduler = self.scheduler
+        anime.priority = spec.get("priority", 1)
+        anime.telemetry = self.telemetry
+        anime.max_dl_threads = self.config["general"]["max_dl_threads"]
+        anime.max_connections = self.config["general"]["max_connections"]
+
+        # Use the stored config of the anime if there is one
+        url = remove_lang_tag(spec["url"]) if spec.get("url") else None
+        with self.lock:
+            for title in self.config["anime"]:
+                if title == spec.get("title") or url and self.config["anime"][title]["url"] == url:
+                    anime.config = self.config["anime"][title]
+                    break
+            else:
+                if not url:
+                    raise ValueError(f"Unknown anime {spec['title']}")
+                anime.config["url"] = url
+
+        anime.config["custom"].update(custom_options(self.arguments))
+        anime.config["ffmpeg_location"] = self.config["general"]["ffmpeg_location"]
+        anime.config["username"] = self.config["general"]["username"]
+        anime.config["password"] = self.config["general"]["password"]
+        anime.config["verbosity"] = self.verbosity
+        anime.config.setdefault("downloaded", [])
+
+        if not anime.config["videos"]:
+            anime.get_info()
+            if not any(episode.available for episode in anime.config["videos"].values()):
+                raise ValueError(f"No episodes of {url} are available")
+
+        if spec.get("output"):
+            anime.config["output"] = spec["output"]
+            if os.path.isdir(anime.config["output"]):
+                anime.config["output"] = os.path.join(anime.config["output"], DEFAULT_OUTPUT_SYNTAX)
+        if not anime.config.get("output"):
+            raise ValueError("No output path")
+
+        available = [index for index, episode in anime.config["videos"].items() if episode.available]
+        if spec.get("episodes"):
+            dl_index = [index for index in parse_index(str(spec["episodes"])) if index in available]
+        else:
+            dl_index = available
+        # Episodes of interrupted jobs which have already been downloaded are skipped
+        dl_index = [index for index in dl_index if index not in anime.config["downloaded"]]
+
+        # Save session (or continue the one of an interrupted job); finished episodes are removed from it as soon as they have been downloaded
+        with self.lock:
+            for entry in self.config["sessions"]:
+                if entry == [anime.config["title"], dl_index]:
+                    break
+            else:
+                entry = [anime.config["title"], list(dl_index)]
+                self.config["sessions"].append(entry)
+            save_config(self.config, anime, self.state)
+
+        def on_finished(index):
+            with self.lock:
+                if index in entry[1]:
+                    entry[1].remove(index)
+                    self.state.save_sessions(self.config["sessions"])
+        anime.state = self.state
+        anime.on_finished = on_finished
+
+        if self.coordinator:
+            futures = self.coordinator.queue_tasks(anime, dl_index)
+            if queued:
+                queued()
+            concurrent.futures.wait(futures)
+        else:
+            anime.open_batch()
+            for index in dl_index:
+                anime.queue_download(anime.config["videos"][index])
+            if queued:
+                queued()
+            anime.close_batch()
+
+        # Remove this session
+        with self.lock:
+            self.config["sessions"].remove(entry)
+            save_config(self.config, anime, self.state)
+        if entry[1]:
+            raise RuntimeError(f"Could not download episode(s) {', '.join(str(index) for index in entry[1])}")
+
+class Coordinator(object):
+    """
+    Distributes the downloads of the daemon to workers (main.py -worker), e.g. one worker per VPN exit IP.
+    Every episode is a task which is leased to one worker at a time; workers renew their lease with heartbeats while
+    downloading and report the result, which is checkpointed in the state store of the daemon (Anime._finished).
+    Tasks of workers which stopped sending heartbeats are leased again; failed tasks are retried up to self.max_attempts times.
+    Protocol: TCP, one JSON object per line in both directions; requests are
+    {"op": "lease", "worker": name} -> {"task": {"id", "title", "output", "episode"} or null, "lease": seconds, "retry": seconds},
+    {"op": "heartbeat", "worker": name, "task": id} -> {"ok": whether the lease is still held} and
+    {"op": "finish", "worker": name, "task": id, "error": null or message} -> {"ok": whether the worker held the lease}.
+    Results of workers which lost their lease are ignored.
+    """
+
+    def __init__(self, lease=60, max_attempts=3, retry=1, telemetry=None):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry = retry
+        self.telemetry = telemetry or Telemetry()
+
+        # Heap of (priority, order, task id) of the queued tasks
+        self.queue = []
+        # task id: {"anime", "episode", "order", "attempts", "future"}
+        self.tasks = {}
+        # task id: [worker, expiry]
+        self.leases = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def serve(self, port, host=""):
+        """
+        Accept workers in a background thread.
+        """
+        coordinator = self
+
+        class WorkerHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = coordinator.handle(json.loads(line))
+                    except (ValueError, KeyError, TypeError) as e:
+                        response = {"error": str(e) or type(e).__name__}
+                    self.wfile.write((json.dumps(response) + "\n").encode())
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        server = Server((host, port), WorkerHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def queue_tasks(self, anime, dl_index):
+        """
+        Queue the episodes in dl_index as tasks; returns a future per task, whose result is whether it succeeded.
+        """
+        futures = []
+        with self.lock:
+            for index in dl_index:
+                episode = anime.config["videos"][index]
+                task_id = next(self.ids)
+                order = -index if anime.newest_first else index
+                self.tasks[task_id] = {"anime": anime, "episode": episode, "order": order, "attempts": 0, "future": concurrent.futures.Future()}
+                heapq.heappush(self.queue, (anime.priority, order, task_id))
+                futures.append(self.tasks[task_id]["future"])
+            self.telemetry.set("tasks_queued", len(self.queue))
+        return futures
+
+    def handle(self, request):
+        op = request["op"]
+        worker = str(request.get("worker"))
+        if op == "lease":
+            return self._lease(worker)
+        if op == "heartbeat":
+            with self.lock:
+                lease = self.leases.get(request["task"])
+                if lease is None or lease[0] != worker:
+                    return {"ok": False}
+                lease[1] = time.monotonic() + self.lease
+            return {"ok": True}
+        if op == "finish":
+            return {"ok": self._finish(request["task"], worker, request.get("error"))}
+        raise ValueError(f"Unknown op {op}")
+
+    def _lease(self, worker):
+        finished = self._expire()
+        try:
+            with self.lock:
+                if not self.queue:
+                    return {"task": None, "retry": self.retry}
+                task_id = heapq.heappop(self.queue)[2]
+                task = self.tasks[task_id]
+                task["attempts"] += 1
+                self.leases[task_id] = [worker, time.monotonic() + self.lease]
+                self.telemetry.set("tasks_queued", len(self.queue))
+                self.telemetry.set("tasks_leased", len(self.leases))
+        finally:
+            self._complete(finished)
+
+        anime = task["anime"]
+        print(f"Leased {anime.config['title']} [{task['episode'].playlist_index}] to {worker}")
+        return {
+            "task": {"id": task_id, "title": anime.config["title"], "output": anime.config["output"], "episode": task["episode"].to_dict()},
+            "lease": self.lease,
+            "retry": self.retry
+            }
+
+    def _finish(self, task_id, worker, error=None):
+        """
+        Store the result of task_id if worker holds its lease; returns whether it was stored.
+        """
+        with self.lock:
+            lease = self.leases.get(task_id)
+            # The lease has expired; the task has been queued or leased again (or has no attempts left)
+            if lease is None or lease[0] != worker:
+                return False
+            task = self.tasks[task_id]
+            del self.leases[task_id]
+            self.telemetry.set("tasks_leased", len(self.leases))
+            if error:
+                self.telemetry.count("tasks_failed_total")
+                print(f"{worker} could not download {task['anime'].config['title']} [{task['episode'].playlist_index}]:", error)
+                if task["attempts"] < self.max_attempts:
+                    heapq.heappush(self.queue, (task["anime"].priority, task["order"], task_id))
+                    self.telemetry.set("tasks_queued", len(self.queue))
+                    return True
+            del self.tasks[task_id]
+        self._complete([(task, not error)])
+        return True
+
+    def _expire(self):
+        """
+        Queue the tasks with expired leases again; returns [(task, False)] of the ones which have no attempts left.
+        """
+        now = time.monotonic()
+        finished = []
+        with self.lock:
+            for task_id, (worker, expiry) in list(self.leases.items()):
+                if expiry > now:
+                    continue
+                del self.leases[task_id]
+                task = self.tasks[task_id]
+                self.telemetry.count("tasks_expired_total")
+                print(f"Lease of {task['anime'].config['title']} [{task['episode'].playlist_index}] by {worker} expired")
+                if task["attempts"] < self.max_attempts:
+                    heapq.heappush(self.queue, (task["anime"].priority, task["order"], task_id))
+                else:
+                    del self.tasks[task_id]
+                    finished.append((task, False))
+            self.telemetry.set("tasks_leased", len(self.leases))
+        return finished
+
+    def _complete(self, finished):
+        for task, success in finished:
+            if success:
+                task["anime"]._finished(task["episode"])
+            task["future"].set_result(success)
+
+class Worker(object):
+    """
+    Downloads the episodes leased from a coordinator (main.py --daemon -coordinator); see Coordinator.
+    self.slots episodes are downloaded at once; they share the download threads and HLS connections like the jobs of the daemon.
+    """
+
+    def __init__(self, config, address, name=None, slots=2, arguments=[], verbosity=1):
+        self.config = config
+        self.address = address
+        self.name = name or socket.gethostname()
+        self.slots = slots
+        self.arguments = arguments
+        self.verbosity = verbosity
+        # SubtitleStore shared by all tasks
+        self.subtitles = None
+
+        # Shared by all tasks
+        self.session = Session()
+        self.limiter = RateLimiter()
+        self.telemetry = Telemetry()
+        self.telemetry.sources.append(self.limiter)
+        # Created by run() with the final config
+        self.scheduler = None
+
+    def run(self):
+        self.scheduler = DownloadScheduler(self.config["general"]["max_dl_threads"], self.config["general"]["max_connections"])
+        slots = [threading.Thread(target=self.work, args=(slot,), daemon=True) for slot in range(self.slots)]
+        for slot in slots:
+            slot.start()
+        for slot in slots:
+            slot.join()
+
+    def work(self, slot):
+        name = f"{self.name}/{slot}"
+        connection = None
+        while True:
+            try:
+                if connection is None:
+                    connection = socket.create_connection(self.address)
+                    stream = connection.makefile("rwb")
+                    print(f"{name} connected to {self.address[0]}:{self.address[1]}")
+
+                def request(**request):
+                    request["worker"] = name
+                    stream.write((json.dumps(request) + "\n").encode())
+                    stream.flush()
+                    line = stream.readline()
+                    if not line:
+                        raise ConnectionError("Connection closed by the coordinator")
+                    return json.loads(line)
+
+                response = request(op="lease")
+                if response.get("task") is None:
+                    time.sleep(response.get("retry", 5))
+                    continue
+                error = self.download(response["task"], response["lease"], request)
+                request(op="finish", task=response["task"]["id"], error=error)
+            except (OSError, ValueError) as e:
+                print(f"{name} lost the connection to the coordinator:", e)
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                time.sleep(5)
+
+    def download(self, task, lease, request):
+        """
+        Download the episode of task while renewing its lease; returns None or the error.
+        """
+        episode = Episode.from_dict(task["episode"])
+
+        anime = Anime(self.session)
+        anime.subtitles = self.subtitles
+        anime.limiter = self.limiter
+        anime.scheduler = self.scheduler
+        anime.telemetry = self.telemetry
+        anime.config.update({
+            "title": task["title"],
+            "output": task["output"],
+            "videos": {episode.playlist_index: episode},
+            "ffmpeg_location": self.config["general"]["ffmpeg_location"],
+            "username": self.config["general"]["username"],
+            "password": self.config["general"]["password"],
+            "verbosity": self.verbosity,
+            })
+        anime.config["custom"].update(custom_options(self.arguments))
+
+        # The download is cancelled once the lease is lost, so it doesn't write the files of the new leaseholder
+        lost = threading.Event()
+        def cancel(status):
+            if lost.is_set():
+                raise DownloadCancelled(f"Lost the lease of {task['title']} [{episode.playlist_index}]")
+        anime.progress_hooks.append(cancel)
+
+        # Heartbeats are sent on the connection of this slot, which isn't used otherwise during the download
+        stop = threading.Event()
+        def heartbeat():
+            while not stop.wait(lease / 3):
+                try:
+                    if not request(op="heartbeat", task=task["id"]).get("ok"):
+                        print(f"Lost the lease of {task['title']} [{episode.playlist_index}], cancelling the download")
+                        lost.set()
+                        return
+                except (OSError, ValueError):
+                    return
+        heartbeats = threading.Thread(target=heartbeat, daemon=True)
+        heartbeats.start()
+        try:
+            anime.start_download([episode.playlist_index])
+        except Exception as e:
+            return str(e) or type(e).__name__
+        finally:
+            stop.set()
+            heartbeats.join()
+        if lost.is_set():
+            return "Lost the lease"
+        if episode.playlist_index not in anime.config["downloaded"]:
+            return "Download failed"
+        return None
+
 ###########
 
-def save_config(config, anime, config_path):
-    # Update global config from Anime instace
+def sync_library(config, state, arguments=[], verbosity=1, cache=None, telemetry=None, refresh=False, max_threads=50):
+    """
+    Update the videos of every stored anime and queue the new ones as jobs for the daemon.
+    All anime are updated at once; they share max_threads concurrent requests and the request rate.
+    If refresh is set, the info of every video is requested again (as far as the cache allows), not only of new ones.
+    """
+    session = Session()
+    limiter = RateLimiter(concurrency=max_threads)
+    if telemetry:
+        telemetry.sources.append(limiter)
+    table = PrettyTable(["Anime", "New episodes", "Job"])
+
+    library = {}
+    for title in list(config["anime"]):
+        anime = Anime(session)
+        anime.cache = cache
+        anime.limiter = limiter
+        if telemetry:
+            anime.telemetry = telemetry
+        anime.config = config["anime"][title]
+        anime.config["custom"].update(custom_options(arguments))
+        anime.config["ffmpeg_location"] = config["general"]["ffmpeg_location"]
+        anime.config["username"] = config["general"]["username"]
+        anime.config["password"] = config["general"]["password"]
+        anime.config["verbosity"] = verbosity
+        library[title] = anime
+
+    engine = MetadataEngine(max_threads)
+    results = engine.run(engine.gather([anime.extract_sync(engine, refresh) for anime in library.values()]))
+
+    for (title, anime), result in zip(library.items(), results):
+        if isinstance(result, (youtube_dl.utils.DownloadError, youtube_dl.utils.ExtractorError)):
+            print(f"Could not sync {title}:", result)
+            continue
+        if isinstance(result, BaseException):
+            raise result
+        new, remap = result
+
+        # Indices of unfinished sessions and partial downloads have to follow the new playlist
+        for entry in config["sessions"]:
+            if entry[0] == title:
+                entry[1] = [remap[index] for index in entry[1] if index in remap]
+        state.remap_progress(title, remap)
+
+        job_id = None
+        if new and anime.config.get("output"):
+            # New episodes are downloaded before the episodes of other jobs
+            job_id = state.add_job({"title": title, "episodes": ",".join(str(index) for index in new), "priority": 0})
+        table.add_row([title, ", ".join(str(index) for index in new), job_id if job_id else ""])
+
+        save_config(config, anime, state)
+
+    print(table)
+    if verbosity > 1 or limiter.blocked:
+        print(limiter)
+    # The daemon reports the requests of its own limiter
+    if telemetry:
+        telemetry.sources.remove(limiter)
+
+def list_library(config, title=None):
+    """
+    Print the stored anime and the unfinished sessions or the stored episodes of the anime title.
+    """
+    if title is not None:
+        if title not in config["anime"]:
+            print("Unknown anime:", title)
+            return
+        anime = Anime()
+        anime.config = config["anime"][title]
+        if not anime.config["videos"]:
+            print("No episodes stored for", title)
+            return
+        anime.print_info()
+        print("Videos downloaded:", anime.config.get("downloaded", []))
+        return
+
+    table = PrettyTable(["Anime", "Available episodes", "Downloaded"])
+    for title in config["anime"]:
+        anime_config = config["anime"][title]
+        available = sum(episode.available for episode in (anime_config["videos"] or {}).values())
+        table.add_row([title, available, len(anime_config.get("downloaded", []))])
+    print(table)
+
+    if config["sessions"]:
+        table = PrettyTable(["ID", "Anime", "Episodes"])
+        for i, session in enumerate(config["sessions"]):
+            table.add_row([i, *session])
+        print("Unfinished downloads:\n", table)
+
+DEFAULT_OUTPUT_SYNTAX = "[%(playlist_index)s] %(series)s - S%(season_number)sE%(episode_number)s - %(episode)s.%(ext)s"
+
+def save_config(config, anime, state):
+    # Update global config from Anime instace; only changed records are written
     config["anime"].update({anime.config["title"]: anime.config})
 
-    # Write to config file
-    with open(config_path, "w") as config_file:
-        yaml.dump(config, config_file, default_flow_style=False)
+    state.save_general(config["general"])
+    state.save_sessions(config["sessions"])
+
+def load_config(state):
+    return {
+        "general": {
+            "ffmpeg_location": None,
+            "filedialog": None,
+            **state.load_general()
+            },
+        "anime": AnimeIndex(state),
+        "sessions": state.load_sessions()
+        }
+
+def migrate_config(yaml_path, state):
+    """
+    Import a config.yml written by older versions into state.
+    """
+    import yaml
+
+    with open(yaml_path, "r") as config_file:
+        config = yaml.load(config_file, Loader=yaml.FullLoader)
+    if not isinstance(config, dict) or not "general" in config or not "anime" in config:
+        return
+
+    state.save_general(config["general"])
+    for anime_config in config["anime"].values():
+        if anime_config["videos"] is not None:
+            anime_config["videos"] = {int(index): Episode.from_dict(dict(video_dict, playlist_index=int(index)))
+                for index, video_dict in anime_config["videos"].items()}
+        state.save_anime(anime_config)
+    state.save_sessions(config.get("sessions") or [])
 
 def remove_lang_tag(url):
     url_components = list(urlparse(url))
     url_components[2] = path=re.sub(r"^\/[a-z]{2}\/", "", url_components[2])
     return urlunparse(url_components)
 
+class EpisodeListParser(html.parser.HTMLParser):
+    """
+    Incrementally collects the episode URLs of a crunchyroll page.
+    Every video sequence (season and language) is appended to self.sequences as soon as its end tag was parsed.
+    """
+
+    SEQUENCE_CLASSES = {"season", "small-margin-bottom"}
+    EPISODE_CLASSES = {"portrait-element", "block-link", "titlefix", "episode"}
+
+    def __init__(self):
+        super().__init__()
+        self.sequences = []
+        # URLs of the sequence which is currently parsed and its open <li>, <ul> and <ol> tags (the first one is the sequence)
+        self.current = None
+        self.open = []
+
+    def handle_starttag(self, tag, attrs):
+        self.start(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        self.end(tag)
+
+    def close(self):
+        super().close()
+        # A sequence which is still open at the end of the page
+        if self.current is not None:
+            self._end_sequence()
+
+    def start(self, tag, attrs):
+        if tag == "li":
+            # End tags of <li> are optional; a <li> ends the open <li> of the same list
+            if self.current is not None and self.open[-1] == "li":
+                self.open.pop()
+                if not self.open:
+                    self._end_sequence()
+            if self.current is not None:
+                self.open.append("li")
+            elif self.SEQUENCE_CLASSES <= set((attrs.get("class") or "").split()):
+                self.current = []
+                self.open = ["li"]
+        elif tag in ("ul", "ol") and self.current is not None:
+            self.open.append(tag)
+        elif tag == "a" and self.current is not None and attrs.get("href"):
+            if self.EPISODE_CLASSES <= set((attrs.get("class") or "").split()):
+                self.current.append("https://www.crunchyroll.com" + attrs["href"])
+
+    def end(self, tag):
+        if tag not in ("li", "ul", "ol") or self.current is None:
+            return
+        # The end of a list also ends its open <li>; the end of the list of the sequence ends the sequence
+        if tag in self.open:
+            while self.open.pop() != tag:
+                pass
+        elif tag != "li":
+            self.open.clear()
+        if not self.open:
+            self._end_sequence()
+
+    def _end_sequence(self):
+        self.sequences.append(self.current)
+        self.current = None
+        self.open = []
+
+EP_NUMBER_REGEX = re.compile(r"(?<=\/episode-)(\d*)(\.){0,1}(\d*)(?=-)")
+
+def episode_number(url):
+    match = EP_NUMBER_REGEX.search(url)
+    if not match or not match.group(1):
+        return float("inf")
+    return float("".join(match.groups(default="")))
+
+def sort_episodes(urls):
+    """
+    Sort the URLs of one video sequence by episode number in ascending order.
+    """
+    # Crunchyroll default sorts by newest, sorting is faster in reverse order
+    urls.reverse()
+    # Decorate, sort, undecorate; every episode number is only extracted once
+    decorated = [(episode_number(url), index, url) for index, url in enumerate(urls)]
+    decorated.sort()
+    return [url for number, index, url in decorated]
+
+def iter_urls_from_html(html_path, chunk_size=64*1024):
+    """
+    Takes the path of a crunchyroll page's html file.
+    Yields lists, each containing the links to all videos of one video sequence
+    (season and language), each sorted in ascending order, while the file is being read.
+    """
+    handler = EpisodeListParser()
+    lxml_etree = optional_module("lxml.etree")
+
+    if lxml_etree is not None:
+        parser = lxml_etree.HTMLPullParser(events=("start", "end"))
+
+        def read_events():
+            for event, element in parser.read_events():
+                if event == "start":
+                    handler.start(element.tag, element.attrib)
+                else:
+                    handler.end(element.tag)
+                    # Parsed elements aren't needed anymore
+                    element.clear()
+
+        def feed(data):
+            parser.feed(data)
+            read_events()
+    else:
+        feed = handler.feed
+
+    with open(html_path, "r", encoding="utf-8") as html_file:
+        for chunk in iter(lambda: html_file.read(chunk_size), ""):
+            feed(chunk)
+            for urls in handler.sequences:
+                yield sort_episodes(urls)
+            handler.sequences.clear()
+
+    if lxml_etree is not None:
+        # End events of the elements which are still open
+        parser.close()
+        read_events()
+    handler.close()
+    for urls in handler.sequences:
+        yield sort_episodes(urls)
+
 def load_urls_from_html(html_path):
     """
     Takes the path of a crunchyroll page's html file.
     Returns a list of lists, each containing the links to all videos of one video sequence
     (season and language), each sorted in ascending order.
     """
-    res = []
-    with open(html_path, "r", encoding="utf-8") as html_file:
-        soup = BeautifulSoup(html_file, features="html.parser")
-    
-    # Extract URLs
-    episode_sequences = soup.find_all("li", class_="season small-margin-bottom")
-    for index, episode_sequence in enumerate(episode_sequences):
-        episode_elements = episode_sequence.find_all("a", class_="portrait-element block-link titlefix episode")
-        urls = [ "https://www.crunchyroll.com" + episode_element["href"] for episode_element in episode_elements]
-        res.append(urls)
-
-    # Sort result (should be sorted already)
-    ep_number_regex = re.compile(r"(?<=\/episode-)(\d*)(\.){0,1}(\d*)(?=-)")
-    for urls in res:
-        # Crunchyroll default sorts by newest, sorting is faster this way
-        urls.sort(key=lambda x: int("".join(re.findall(ep_number_regex, x)[0])), reverse=True)
-        # Reverse so episode 1 is first
-        urls.reverse()
-
-    return res
+    return list(iter_urls_from_html(html_path))
+
+def partial_size(tmpfilename):
+    """
+    Returns the size of a partial download on disk including the segments downloaded by SegmentedHlsFD.
+    """
+    directory = os.path.dirname(tmpfilename) or "."
+    name = os.path.basename(tmpfilename)
+    try:
+        files = os.listdir(directory)
+    except OSError:
+        return 0
+    return sum(os.path.getsize(os.path.join(directory, file)) for file in files if file == name or file.startswith(name + ".frag"))
+
+@functools.lru_cache(maxsize=None)
+def optional_module(name):
+    """
+    Import the optional module name when it is needed; returns None if it isn't installed.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+def PrettyTable(*args, **kwargs):
+    """
+    Returns a prettytable.PrettyTable; prettytable is imported with the first table.
+    """
+    from prettytable import PrettyTable
+    return PrettyTable(*args, **kwargs)
+
+def get_filedialog():
+    """
+    Returns tkinter.filedialog (creating a hidden Tk root window the first time) or None if Tk can't be used.
+    """
+    global filedialog
+    if filedialog is None:
+        try:
+            from tkinter import Tk, filedialog as tk_filedialog
+
+            # Create and hide Tkinter window
+            root = Tk()
+            root.withdraw()
+            filedialog = tk_filedialog
+        except Exception as e:
+            print(str(e), "\nFalling back to manual input\n")
+            filedialog = False
+    return filedialog or None
+
+def locate_ffmpeg(config, use_filedialog=False, prompt=True):
+    """
+    Set config["general"]["ffmpeg_location"] if the stored path isn't valid; the user is asked for it if prompt is set
+    and it can't be found.
+    """
+    # Check if ffmpeg path is in config file and valid
+    if config["general"]["ffmpeg_location"] and os.path.isfile(config["general"]["ffmpeg_location"]):
+        return config["general"]["ffmpeg_location"]
+
+    if not prompt:
+        config["general"]["ffmpeg_location"] = which("ffmpeg")
+    elif os.name != "nt":
+        config["general"]["ffmpeg_location"] = get_path(["ffmpeg"],  use_filedialog, sys_path=True, msg="Please enter the path of the ffmpeg executable > ")
+    else:
+        config["general"]["ffmpeg_location"] = get_path(["ffmpeg.exe"], use_filedialog, sys_path=True, msg="Please enter the path of the ffmpeg executable > ")
+    return config["general"]["ffmpeg_location"]
 
 def get_path(file_names=[], use_filedialog=False, sys_path=False, msg=None):
     for file_name in file_names:
@@ -305,12 +2766,48 @@ def get_path(file_names=[], use_filedialog=False, sys_path=False, msg=None):
             if file_path and os.access(os.path.normpath(file_path), os.X_OK):
                 return os.path.normpath(file_path)
 
-    if not use_filedialog:
+    if not use_filedialog or get_filedialog() is None:
         if not msg:
             msg = f'Please enter the path to "{file_names[0]}"> '
         return os.path.normpath(input(msg).replace('"', '').replace("'", ""))
     else:
-        return filedialog.askopenfilename(title = file_names[0])
+        return get_filedialog().askopenfilename(title = file_names[0])
+
+def is_blocked(error):
+    """
+    Whether error was caused by Crunchyroll rejecting a request (most likely because of IP blocking or rate limiting).
+    """
+    return re.search(r"HTTP Error (403|429)", str(error)) is not None
+
+def parse_index(text):
+    """
+    Returns the indices of text like "1-5,8" as list.
+    """
+    dl_index = []
+    for i in text.split(","):
+        dl_index.extend(list(range(int(i.split("-")[0]), int(i.split("-")[1])+1)) if "-" in i else [int(i)])
+    return dl_index
+
+def custom_options(arguments):
+    """
+    Returns the YTDL options (every argument containing "-" followed by its value) of arguments.
+    """
+    options = {}
+    for index, argument in enumerate(arguments):
+        if "-" in argument:
+            options.update({argument: arguments[index+1]})
+    return options
+
+def split_sequences(urls):
+    """
+    Split the indices of urls into video sequences (season and language); each sequence begins with "/episode-1-" in its URL.
+    """
+    sequences = []
+    for index, url in enumerate(urls):
+        if not sequences or "/episode-1-" in url:
+            sequences.append([])
+        sequences[-1].append(index)
+    return sequences
 
 def flattened_list(data):
     "Flatten list, maintaining it's order"
@@ -324,17 +2821,86 @@ def flattened_list(data):
 
 ###########
 
-def session(config, config_path, arguments=[], verbosity=1, use_filedialog=False):  
+def choose_output(anime, use_filedialog=False):
+    """
+    Ask for the download folder and the output syntax if anime has no valid output path.
+    Returns whether the output path has been changed.
+    """
+    if anime.config.get("output") and os.path.isdir(os.path.dirname(anime.config["output"])):
+        return False
+
+    # Choose download folder
+    if use_filedialog and get_filedialog():
+        download_path = get_filedialog().askdirectory(title = "Download folder")
+    else:
+        download_path =  os.path.normpath(input("Choose a download folder > ").replace('"', '').replace("'", ""))
+
+    # Choose output syntax
+    temp = input("Type in output syntax; Leave blank for default > ")
+    if temp:
+        output_syntax = temp
+    else:
+        output_syntax = DEFAULT_OUTPUT_SYNTAX
+
+    # Compile to path
+    anime.config["output"] = os.path.join(download_path, output_syntax)
+    return True
+
+def stream_info(anime, urls):
+    """
+    Run anime.get_info() for urls in the background and print the available videos as soon as they are known.
+    The videos to download can be entered meanwhile; known ones are downloaded right away and the others as soon as
+    their info is available (in the batch of anime; see Anime.open_batch()). Returns the entered indices.
+    """
+    table = InfoTable()
+    lock = threading.Lock()
+    # {index: Episode or None} of the videos listed so far and the entered indices
+    known = {}
+    selection = set()
+
+    def found(index, episode):
+        table.add(index, episode)
+        with lock:
+            known[index] = episode
+            if index in selection and episode is not None and episode.available:
+                anime.queue_download(episode)
+
+    anime.open_batch()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        extraction = executor.submit(anime.get_info, found, urls)
+        temp = input("Videos to download (Index) > ")
+        dl_index = parse_index(temp) if temp else []
+
+        with lock:
+            selection.update(dl_index)
+            for index in dl_index:
+                if known.get(index) is not None and known[index].available:
+                    anime.queue_download(known[index])
+
+        extraction.result()
+    table.close()
+    return dl_index
+
+def session(config, state, arguments=[], verbosity=1, use_filedialog=False, cache=None, telemetry=None, subtitles=None):  
+    def prepare_download():
+        w_anime.config["ffmpeg_location"] = locate_ffmpeg(config, use_filedialog)
+        w_anime.config["verbosity"] = verbosity
+        w_anime.max_dl_threads = config["general"]["max_dl_threads"]
+        w_anime.max_connections = config["general"]["max_connections"]
+
     anime = []
 
     # Add new anime object to anime list; define the new entry as working anime
     anime.append(Anime())
     w_anime = anime[-1]
+    w_anime.cache = cache
+    w_anime.subtitles = subtitles
+    if telemetry:
+        w_anime.telemetry = telemetry
+        telemetry.sources.append(w_anime.limiter)
 
     # Process YTDL options
-    for index, argument in enumerate(arguments):
-        if "-" in argument:
-            w_anime.config["custom"].update({argument: arguments[index+1]})
+    w_anime.config["custom"].update(custom_options(arguments))
 
     # Load some configuration from global into Anime instance
     w_anime.use_filedialog = use_filedialog
@@ -356,8 +2922,19 @@ def session(config, config_path, arguments=[], verbosity=1, use_filedialog=False
     if config["sessions"] and session_id != "":
         session = config["sessions"][int(session_id)]
         w_anime.config = config["anime"][session[0]]
+        w_anime.config.setdefault("downloaded", [])
+        # Episodes which have been finished before the session was interrupted or which aren't available anymore
+        session[1] = [
+            index for index in session[1]
+            if index not in w_anime.config["downloaded"] and index in w_anime.config["videos"] and w_anime.config["videos"][index].available
+            ]
         dl_index = session[1]
 
+        partial = [partial_size(filename) for index, (filename, downloaded) in state.load_progress(session[0]).items() if index in dl_index]
+        partial = [size for size in partial if size]
+        if partial:
+            print(f"Resuming {len(partial)} partial download(s) ({sum(partial) / 2**20:.1f} MiB)")
+
     # If there are no sessions to restore or none was selected
     else:
         # Choose anime
@@ -372,102 +2949,133 @@ def session(config, config_path, arguments=[], verbosity=1, use_filedialog=False
         if not choice.isnumeric():
             w_anime.config["url"] = remove_lang_tag(choice)
 
+            # Episodes are downloaded while the others are still listed, so everything needed for downloading is asked first
+            choose_output(w_anime, use_filedialog)
+            prepare_download()
+            # The playlist is requested first, since the user may be asked for a downloaded page
+            w_anime.update_config()
+            urls = w_anime.get_urls()
+
             # Check if at least one episode is available
             while(True):
-                w_anime.get_info()
-                
-                error = True
-                for video_dict in w_anime.config["videos"].values():
-                    if not "error" in video_dict.keys():
-                        error = False
-                        break
-
-                if error:
-                    w_anime.print_info()
-                    if input("Try again? (y/N) > ").upper() != "Y":
-                        exit()
-                else:
+                print("You can enter the videos to download while they are listed")
+                dl_index = stream_info(w_anime, urls)
+
+                if any(episode.available for episode in w_anime.config["videos"].values()):
                     break
+                print("No video is available")
+                if input("Try again? (y/N) > ").upper() != "Y":
+                    w_anime.close_batch()
+                    exit()
             
+            if verbosity > 1 or w_anime.limiter.blocked:
+                print(w_anime.limiter)
+
             # Save w_anime.get_info() results 
-            save_config(config, w_anime, config_path)
+            save_config(config, w_anime, state)
 
         else:
             choice = int(choice)
             # Restore config of chosen anime
             w_anime.config = config["anime"][list(config["anime"])[choice]]
 
+            # Check if output path is set and valid
+            if choose_output(w_anime, use_filedialog):
+                # Save updated output path
+                save_config(config, w_anime, state)
 
-        # Check if output path is set and valid
-        if not "output" in w_anime.config or not w_anime.config["output"] or not os.path.isdir(os.path.dirname(w_anime.config["output"])):
-
-            # Choose download folder
-            if not use_filedialog:
-                download_path =  os.path.normpath(input("Choose a download folder > ").replace('"', '').replace("'", ""))
-            else:
-                download_path = filedialog.askdirectory(title = "Download folder")
-
-            # Choose output syntax
-            temp = input("Type in output syntax; Leave blank for default > ")
-            if temp:
-                output_syntax = temp
-            else:
-                output_syntax = "[%(playlist_index)s] %(series)s - S%(season_number)sE%(episode_number)s - %(episode)s.%(ext)s"
+            # Show episode info
+            w_anime.print_info()
 
-            # Compile to path
-            w_anime.config["output"] = os.path.join(download_path, output_syntax)
+            # Episodes to download
+            print("Videos downloaded:", w_anime.config["downloaded"])
+            temp = input("Videos to download (Index) > ")
+            dl_index = parse_index(temp) if temp else []
 
-            # Save updated output path
-            save_config(config, w_anime, config_path)
+        # Videos which were skipped by get_info aren't in w_anime.config["videos"]
+        unavailable = [index for index in dl_index if index not in w_anime.config["videos"] or not w_anime.config["videos"][index].available]
+        if unavailable:
+            print("Skipping unavailable videos:", ", ".join(str(index) for index in unavailable))
+            dl_index = [index for index in dl_index if index not in unavailable]
 
-        # Show episode info
-        w_anime.print_info()
-
-        # Episodes to download
-        print("Videos downloaded:", w_anime.config["downloaded"])
-        temp = input("Videos to download (Index) > ")
-        if temp:
-            dl_index = []
-            for i in temp.split(","):
-                dl_index.extend(list(range(int(i.split("-")[0]), int(i.split("-")[1])+1)) if "-" in i else [int(i)])
-        else:
+        if not dl_index:
             print("\nNo Video specified.. Exiting")
+            if w_anime.batch:
+                w_anime.close_batch()
             exit()
             
         # Save session
-        if [w_anime.config["title"], dl_index] not in config["sessions"]:
-            config["sessions"].append([w_anime.config["title"], dl_index])
-            save_config(config, w_anime, config_path)
+        for session in config["sessions"]:
+            if session == [w_anime.config["title"], dl_index]:
+                break
+        else:
+            session = [w_anime.config["title"], dl_index]
+            config["sessions"].append(session)
+        save_config(config, w_anime, state)
+
+    # Checkpoint every finished episode
+    lock = threading.Lock()
+    def on_finished(index):
+        with lock:
+            if index in session[1]:
+                session[1].remove(index)
+                state.save_sessions(config["sessions"])
+    w_anime.state = state
+    w_anime.on_finished = on_finished
+    # Episodes which have been finished before, e.g. while the others were listed
+    for index in list(session[1]):
+        if index in w_anime.config["downloaded"]:
+            on_finished(index)
 
     # Download
-    w_anime.config["verbosity"] = verbosity
-    w_anime.max_dl_threads = config["general"]["max_dl_threads"]
+    prepare_download()
     w_anime.start_download(dl_index)
     for thread in concurrent.futures.as_completed(w_anime.dl_threads):
         pass
-
-    # Remove current session and add downloaded episodes to list
-    del config["sessions"][-1]
-    for index in dl_index:
-        w_anime.config["downloaded"].append(index) if index not in w_anime.config["downloaded"] else None
-    save_config(config, w_anime, config_path)
-
-    # Save config
-    config["anime"][w_anime.config["title"]] = w_anime.config
-    with open(config_path, "w") as config_file:
-        yaml.dump(config, config_file, default_flow_style=False)
+    if verbosity > 1 or w_anime.limiter.blocked:
+        print(w_anime.limiter)
+    if verbosity > 1:
+        print(w_anime.session)
+        if w_anime.tuner:
+            print(w_anime.tuner)
+
+    # Remove the session if every episode has been downloaded
+    if not session[1]:
+        config["sessions"].remove(session)
+    else:
+        print("Not downloaded:", session[1])
+    save_config(config, w_anime, state)
 
 def main():
     # Process Arguments
     arguments = sys_argv[1:]
 
+    # Modules are imported when they are needed, but should be reported before anything is done
+    missing = [name for name in ["youtube_dl", "prettytable"] if importlib.util.find_spec(name) is None]
+    if missing:
+        print("Some required modules were not found:\n", ", ".join(missing), "\n\nPlease ensure all modules listed in requirements.txt are installed.")
+        exit()
+
     if "-h" in arguments or "--help" in arguments:
         print(""""-un": Username for Crunchyroll login
 "-pw": Password for Crunchyroll login
 '-t' : Threads to use for downloading
-"-c" : Path to config file
+"-sc": Connections for downloading HLS segments, shared by all download threads; 0 downloads segments sequentially
+"-c" : Path to config database
 "-v" : Verbosity [0 (Default) - 5]
 "-nf": Don't use filedialog; Type in paths manually
+"--refresh": Ignore cached video information and fetch it again; with "--sync" the information of every stored episode is fetched again
+"-subtitle_cache": MiB of subtitles to keep for later downloads of the same episodes (Default: 256); 0 disables the subtitle cache
+"--sync": Check all stored anime for new episodes and queue them as jobs for the daemon
+"--daemon": Process download jobs without user interaction; see "-jobs" and "-socket"
+"-jobs": JSON lines file to read jobs from in daemon mode (Default: jobs.jsonl next to the config database)
+"-socket": Unix socket to accept jobs on in daemon mode
+"-j" : Jobs to prepare at once in daemon mode (Default: 2); episodes to download at once in worker mode
+"-coordinator": Port to distribute the downloads of the daemon to workers on; see "-worker"
+"-worker": Download episodes leased from a coordinator (host:port) instead of processing jobs; "-t", "-sc" and the YouTube-DL options apply
+"-metrics": Port to serve download and extraction metrics on (Prometheus text format)
+"--list": List the stored anime and unfinished sessions
+"-show": List the stored episodes of an anime (title)
 "-h" : Show this help
 
 "-<YouTube-DL option>" : You can use all youtube_dl.YoutubeDL options by just adding a leading "-" that can be found here: 
@@ -479,26 +3087,35 @@ def main():
     if "-c" in arguments:
         config_path = arguments.pop(arguments.index("-c")+1)
         arguments.remove("-c")
-        if not os.path.isfile(config_path):
-            config_path = os.path.join(os.path.dirname(__file__), "config.yml")
+        if not os.path.isdir(os.path.dirname(os.path.abspath(config_path))):
+            config_path = os.path.join(os.path.dirname(__file__), "config.db")
+    else:
+        config_path = os.path.join(os.path.dirname(__file__), "config.db")
+
+    # Config files of older versions are migrated to a database next to them
+    if os.path.splitext(config_path)[1] in [".yml", ".yaml"]:
+        yaml_path = config_path
+        config_path = os.path.splitext(config_path)[0] + ".db"
     else:
-        config_path = os.path.join(os.path.dirname(__file__), "config.yml")
+        yaml_path = os.path.splitext(config_path)[0] + ".yml"
 
     # Read config
-    try:
-        with open(config_path, "r") as config_file:
-            config = yaml.load(config_file, Loader=yaml.FullLoader)
-        if not "general" in config and "anime" in config:
-            assert False
-    except:
-        config = {
-            "general":{
-                "ffmpeg_location": None,
-                "filedialog": None
-                },
-            "anime": {},
-            "sessions": []
-            }
+    state = StateStore(config_path)
+    if state.is_empty() and os.path.isfile(yaml_path):
+        try:
+            migrate_config(yaml_path, state)
+            print(f"Migrated {yaml_path} to {config_path}")
+        except Exception as e:
+            print(f"Could not migrate {yaml_path}:", e)
+    config = load_config(state)
+
+    # List-only operations; neither youtube_dl, Tk nor ffmpeg are needed
+    if "-show" in arguments:
+        list_library(config, arguments[arguments.index("-show")+1])
+        exit()
+    if "--list" in arguments:
+        list_library(config)
+        exit()
 
     # Process Arguments #2
     if "-un" in arguments:
@@ -513,6 +3130,12 @@ def main():
     else:
         config["general"]["max_dl_threads"] = 10
     
+    if "-sc" in arguments:
+        config["general"]["max_connections"] = int(arguments.pop(arguments.index("-sc")+1))
+        arguments.remove("-sc")
+    else:
+        config["general"]["max_connections"] = 16
+
     if "-pw" in arguments:
         config["general"]["password"] = arguments.pop(arguments.index("-pw")+1)
         arguments.remove("-pw")
@@ -525,32 +3148,114 @@ def main():
     else:
         verbosity = 1
 
+    if "--refresh" in arguments:
+        arguments.remove("--refresh")
+        refresh = True
+    else:
+        refresh = False
+
+    if "-subtitle_cache" in arguments:
+        subtitle_cache_size = float(arguments.pop(arguments.index("-subtitle_cache")+1))
+        arguments.remove("-subtitle_cache")
+    else:
+        subtitle_cache_size = 256
+
+    if "--sync" in arguments:
+        arguments.remove("--sync")
+        sync = True
+    else:
+        sync = False
+
+    if "--daemon" in arguments:
+        arguments.remove("--daemon")
+        daemon = Daemon(config, state)
+        daemon.jobs_path = os.path.join(os.path.dirname(config_path), "jobs.jsonl")
+        if "-jobs" in arguments:
+            daemon.jobs_path = arguments.pop(arguments.index("-jobs")+1)
+            arguments.remove("-jobs")
+        if "-socket" in arguments:
+            daemon.socket_path = arguments.pop(arguments.index("-socket")+1)
+            arguments.remove("-socket")
+        if "-j" in arguments:
+            daemon.max_jobs = int(arguments.pop(arguments.index("-j")+1))
+            arguments.remove("-j")
+        if "-coordinator" in arguments:
+            daemon.coordinator_port = int(arguments.pop(arguments.index("-coordinator")+1))
+            arguments.remove("-coordinator")
+        # There is no one to answer prompts
+        if "-nf" not in arguments:
+            arguments.append("-nf")
+    else:
+        daemon = None
+
+    if "-worker" in arguments and not daemon:
+        host, port = arguments.pop(arguments.index("-worker")+1).rsplit(":", 1)
+        arguments.remove("-worker")
+        worker = Worker(config, (host, int(port)))
+        if "-j" in arguments:
+            worker.slots = int(arguments.pop(arguments.index("-j")+1))
+            arguments.remove("-j")
+        # There is no one to answer prompts
+        if "-nf" not in arguments:
+            arguments.append("-nf")
+    else:
+        worker = None
+
+    if "-metrics" in arguments:
+        metrics_port = int(arguments.pop(arguments.index("-metrics")+1))
+        arguments.remove("-metrics")
+    else:
+        metrics_port = None
+
+    if sync and "-nf" not in arguments:
+        arguments.append("-nf")
+
     if "-nf" in arguments:
         arguments.remove("-nf")
         use_filedialog = False
     else:
-        try:
-            global Tk, filedialog
-            from tkinter import Tk, filedialog
-            use_filedialog = True
+        # The Tk window is created when the first file dialog is shown
+        use_filedialog = True
+
+    # ffmpeg is located in session() right before it is needed
+    if daemon or sync or worker:
+        locate_ffmpeg(config, use_filedialog, prompt=False)
+
+    # Cache video information in the config database
+    cache = MetadataCache(state)
+    cache.refresh = refresh
+    # Subtitles are stored in a folder next to the config file
+    if subtitle_cache_size > 0:
+        subtitles = SubtitleStore(os.path.join(os.path.dirname(config_path), "subtitles"), int(subtitle_cache_size * 2**20))
+    else:
+        subtitles = None
 
-            # Create and hide Tkinter window
-            root = Tk()
-            root.withdraw()  
+    telemetry = daemon.telemetry if daemon else worker.telemetry if worker else Telemetry()
+    if metrics_port:
+        telemetry.serve(metrics_port)
 
-        except Exception as e:
-            print(str(e), "\nFalling back to manual input\n")
-            use_filedialog = False
+    if worker:
+        worker.arguments = arguments
+        worker.verbosity = verbosity
+        worker.subtitles = subtitles
+        worker.run()
+        exit()
 
-    # Locate ffmpeg
-    # Check if ffmpeg path is in config file and valid
-    if not config["general"]["ffmpeg_location"] or not os.path.isfile(config["general"]["ffmpeg_location"]):
-        if os.name != "nt":
-            config["general"]["ffmpeg_location"] = get_path(["ffmpeg"],  use_filedialog, sys_path=True, msg="Please enter the path of the ffmpeg executable > ")
-        else:
-            config["general"]["ffmpeg_location"] = get_path(["ffmpeg.exe"], use_filedialog, sys_path=True, msg="Please enter the path of the ffmpeg executable > ")
+    if sync:
+        sync_library(config, state, arguments, verbosity, cache, telemetry, refresh)
+        if not daemon:
+            print("Run with --daemon to download queued jobs")
+            exit()
 
-    session(config, config_path, arguments, verbosity, use_filedialog)
+    if daemon:
+        state.save_general(config["general"])
+        daemon.arguments = arguments
+        daemon.verbosity = verbosity
+        daemon.cache = cache
+        daemon.subtitles = subtitles
+        daemon.run()
+    else:
+        session(config, state, arguments, verbosity, use_filedialog, cache, telemetry, subtitles)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
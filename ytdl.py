@@ -0,0 +1,288 @@
+"""
+Classes based on youtube_dl; imported by main.load_youtube_dl(), which makes youtube_dl load only the Crunchyroll extractors.
+"""
+
+import os
+import re
+import time
+import random
+import struct
+import binascii
+import threading
+import http.client
+import concurrent.futures
+
+import youtube_dl
+
+from main import KeepAliveMixin, optional_module, is_blocked
+
+class SegmentedHlsFD(youtube_dl.downloader.common.FileDownloader):
+    """
+    Downloads the segments of a HLS stream in parallel using params["segment_scheduler"].
+    Every segment is written to its own file first, so an interrupted download resumes at segment granularity.
+    Every segment request takes a token of params["limiter"] if it is set; failed segments are retried with backoff.
+    """
+
+    FD_NAME = "hlssegmented"
+
+    def real_download(self, filename, info_dict):
+        manifest_url = info_dict["url"]
+        headers = info_dict.get("http_headers", {})
+        self.to_screen(f"[{self.FD_NAME}] Downloading m3u8 manifest")
+        manifest_handle = self.ydl.urlopen(youtube_dl.utils.sanitized_Request(manifest_url, None, headers))
+        manifest_url = manifest_handle.geturl()
+        manifest = manifest_handle.read().decode("utf-8", "ignore")
+        AES = optional_module("Crypto.Cipher.AES")
+
+        # Let youtube-dl handle what isn't supported here
+        if (re.search(r"#EXT-X-KEY:METHOD=(?!NONE|AES-128)|#EXT-X-MAP:|#EXT-X-BYTERANGE", manifest)
+                or "#EXT-X-KEY:METHOD=AES-128" in manifest and AES is None):
+            self.report_warning(f"{self.FD_NAME} has detected features it does not support, extraction will be delegated to ffmpeg")
+            fd = youtube_dl.downloader.external.FFmpegFD(self.ydl, self.params)
+            for hook in self._progress_hooks:
+                fd.add_progress_hook(hook)
+            return fd.real_download(filename, info_dict)
+
+        segments = self.parse_manifest(manifest, manifest_url)
+        tmpfilename = self.temp_name(filename)
+        scheduler = self.params["segment_scheduler"]
+        keys = {}
+        keys_lock = threading.Lock()
+        # Set once the download has been given up, so running segments don't write their files anymore
+        stopped = threading.Event()
+
+        def get_key(uri):
+            with keys_lock:
+                if uri not in keys:
+                    keys[uri] = self.ydl.urlopen(youtube_dl.utils.sanitized_Request(uri, None, headers)).read()
+                return keys[uri]
+
+        def download_segment(index, segment):
+            if stopped.is_set():
+                return 0
+            segment_filename = f"{tmpfilename}.frag{index}"
+            retries = self.params.get("fragment_retries", 10)
+            limiter = self.params.get("limiter")
+            for count in range(retries + 1):
+                # Every segment takes a token of the limiter, but no slot, since the download already holds its threads
+                if limiter:
+                    limiter.acquire(slot=False)
+                try:
+                    content = self.ydl.urlopen(youtube_dl.utils.sanitized_Request(segment["url"], None, headers)).read()
+                except (youtube_dl.compat.compat_urllib_error.URLError, OSError, http.client.HTTPException) as err:
+                    blocked = is_blocked(err)
+                    if limiter:
+                        limiter.release(blocked, slot=False)
+                    if count == retries:
+                        raise
+                    self.to_screen(f"[{self.FD_NAME}] Got server error: {err}. Retrying segment {index + 1} ({count + 1}/{retries})...")
+                    backoff = limiter.backoff if limiter and blocked else 0.5
+                    time.sleep(min(backoff * 2 ** count, 60) * random.uniform(0.5, 1.5))
+                else:
+                    if limiter:
+                        limiter.release(slot=False)
+                    break
+            if stopped.is_set():
+                return 0
+            if segment["key"]:
+                content = AES.new(get_key(segment["key"]), AES.MODE_CBC, segment["iv"]).decrypt(content)
+            # Write to a temporary file first, so only complete segments exist under segment_filename
+            with open(segment_filename + ".tmp", "wb") as segment_file:
+                segment_file.write(content)
+            os.replace(segment_filename + ".tmp", segment_filename)
+            return len(content)
+
+        # Resume: segments which have been downloaded before are skipped
+        start = time.time()
+        downloaded_bytes = 0
+        futures = []
+        for index, segment in enumerate(segments):
+            if os.path.isfile(f"{tmpfilename}.frag{index}"):
+                downloaded_bytes += os.path.getsize(f"{tmpfilename}.frag{index}")
+            else:
+                futures.append(scheduler.submit(download_segment, index, segment))
+
+        # Progress is reported from this thread only
+        finished_segments = len(segments) - len(futures)
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                downloaded_bytes += future.result()
+                finished_segments += 1
+                elapsed = time.time() - start
+                self._hook_progress({
+                    "status": "downloading",
+                    "filename": filename,
+                    "tmpfilename": tmpfilename,
+                    "downloaded_bytes": downloaded_bytes,
+                    "total_bytes_estimate": downloaded_bytes * len(segments) / finished_segments,
+                    "fragment_index": finished_segments,
+                    "fragment_count": len(segments),
+                    "elapsed": elapsed,
+                    "speed": downloaded_bytes / elapsed if elapsed else None,
+                    "eta": elapsed * (len(segments) - finished_segments) / finished_segments,
+                })
+        except (youtube_dl.compat.compat_urllib_error.URLError, OSError, http.client.HTTPException) as err:
+            stopped.set()
+            for future in futures:
+                future.cancel()
+            self.report_error(f"giving up on segment download: {err}")
+            return False
+        except BaseException:
+            # E.g. DownloadCancelled raised by a progress hook
+            stopped.set()
+            for future in futures:
+                future.cancel()
+            raise
+
+        # Write the segments in order into the preallocated file
+        with open(tmpfilename, "wb") as output_file:
+            output_file.truncate(downloaded_bytes)
+            for index in range(len(segments)):
+                with open(f"{tmpfilename}.frag{index}", "rb") as segment_file:
+                    output_file.write(segment_file.read())
+        for index in range(len(segments)):
+            os.remove(f"{tmpfilename}.frag{index}")
+        self.try_rename(tmpfilename, filename)
+
+        self._hook_progress({
+            "status": "finished",
+            "filename": filename,
+            "downloaded_bytes": downloaded_bytes,
+            "total_bytes": downloaded_bytes,
+            "elapsed": time.time() - start,
+        })
+
+        # YoutubeDL checks the protocol afterwards to apply the fixup for HLS downloads
+        info_dict["protocol"] = "m3u8_native"
+        return True
+
+    @staticmethod
+    def parse_manifest(manifest, manifest_url):
+        """
+        Returns a list of {"url", "key", "iv"} for all segments of a media playlist.
+        """
+        segments = []
+        media_sequence = 0
+        key = {"METHOD": "NONE"}
+        for line in manifest.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            elif line.startswith("#EXT-X-KEY"):
+                key = youtube_dl.utils.parse_m3u8_attributes(line[11:])
+                if key["METHOD"] == "AES-128":
+                    key["URI"] = youtube_dl.compat.compat_urlparse.urljoin(manifest_url, key["URI"])
+                    if "IV" in key:
+                        key["IV"] = binascii.unhexlify(key["IV"][2:].zfill(32))
+            elif line.startswith("#EXT-X-MEDIA-SEQUENCE"):
+                media_sequence = int(line[22:])
+            elif not line.startswith("#"):
+                encrypted = key["METHOD"] == "AES-128"
+                segments.append({
+                    "url": youtube_dl.compat.compat_urlparse.urljoin(manifest_url, line),
+                    "key": key["URI"] if encrypted else None,
+                    "iv": (key.get("IV") or struct.pack(">8xq", media_sequence)) if encrypted else None,
+                })
+                media_sequence += 1
+        return segments
+
+class KeepAliveHTTPHandler(KeepAliveMixin, youtube_dl.utils.YoutubeDLHandler):
+    pass
+
+class KeepAliveHTTPSHandler(KeepAliveMixin, youtube_dl.utils.YoutubeDLHTTPSHandler):
+    pass
+
+class Downloader(youtube_dl.YoutubeDL):
+    """
+    YoutubeDL which downloads HLS streams with SegmentedHlsFD if params["segment_scheduler"] is set
+    and shares its connections and login with other instances if params["session"] is set.
+    """
+
+    # Future of the last postprocessing submitted to params["postprocess_executor"]
+    postprocessed = None
+
+    def _setup_opener(self):
+        session = self.params.get("session")
+        if session is None:
+            return super()._setup_opener()
+        session.setup_opener(self)
+        session.downloaders += 1
+
+    def get_info_extractor(self, ie_key):
+        new = ie_key not in self._ies_instances
+        ie = super().get_info_extractor(ie_key)
+        if new and self.params.get("session"):
+            self.params["session"].init_extractor(ie)
+        return ie
+
+    def process_info(self, info_dict):
+        if (self.params.get("segment_scheduler") and info_dict.get("protocol") in ["m3u8", "m3u8_native"]
+                and not info_dict.get("is_live") and not self.params.get("external_downloader")):
+            info_dict["protocol"] = "m3u8_segmented"
+
+        # Subtitles in params["subtitle_store"] are written from there; the others are stored once they have been fetched
+        store = self.params.get("subtitle_store")
+        if store and self.params.get("writesubtitles") and info_dict.get("requested_subtitles"):
+            fetched = info_dict["__fetched_subtitles"] = []
+            for language, sub_info in info_dict["requested_subtitles"].items():
+                if sub_info.get("data") is not None:
+                    continue
+                data = store.get(info_dict["id"], language, sub_info["ext"])
+                try:
+                    sub_info["data"] = data.decode("utf-8")
+                except (AttributeError, UnicodeDecodeError):
+                    fetched.append((language, sub_info["ext"]))
+
+        try:
+            super().process_info(info_dict)
+        finally:
+            # Also if the download of the video failed, so it is retried without fetching the subtitles again
+            self.store_subtitles(info_dict)
+
+    def store_subtitles(self, info_dict):
+        """
+        Put the subtitles fetched for info_dict into params["subtitle_store"].
+        Must be called before the postprocessors run, since FFmpegEmbedSubtitle deletes the subtitle files.
+        """
+        fetched = info_dict.pop("__fetched_subtitles", None)
+        if not fetched or not info_dict.get("_filename"):
+            return
+        for language, ext in fetched:
+            sub_filename = youtube_dl.utils.subtitles_filename(info_dict["_filename"], language, ext, info_dict.get("ext"))
+            try:
+                with open(sub_filename, "rb") as sub_file:
+                    self.params["subtitle_store"].put(info_dict["id"], language, ext, sub_file.read())
+            except OSError as err:
+                self.report_warning(f"Unable to store the {language} subtitles: {err}")
+
+    def post_process(self, filename, ie_info):
+        """
+        Run the postprocessors in params["postprocess_executor"] if it is set,
+        so the download thread can continue with the next download in the meantime.
+        """
+        self.store_subtitles(ie_info)
+        executor = self.params.get("postprocess_executor")
+        if executor is None:
+            return super().post_process(filename, ie_info)
+        if self.params.get("telemetry"):
+            self.params["telemetry"].adjust("postprocess_queue", 1)
+        self.postprocessed = executor.submit(self._post_process, filename, ie_info)
+
+    def _post_process(self, filename, ie_info):
+        """
+        Returns whether the postprocessors succeeded; params["postprocessed_hook"]() is called if they did.
+        """
+        try:
+            super().post_process(filename, ie_info)
+            if self.params.get("postprocessed_hook"):
+                self.params["postprocessed_hook"]()
+            return True
+        # The error has already been reported by the logger
+        except (youtube_dl.utils.PostProcessingError, youtube_dl.utils.DownloadError):
+            return False
+        finally:
+            if self.params.get("telemetry"):
+                self.params["telemetry"].adjust("postprocess_queue", -1)
+
+# Used for info dicts marked by Downloader.process_info
+youtube_dl.downloader.PROTOCOL_MAP["m3u8_segmented"] = SegmentedHlsFD